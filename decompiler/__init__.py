@@ -20,11 +20,11 @@
 
 from __future__ import unicode_literals
 from util import DecompilerBase, First, WordConcatenator, reconstruct_paraminfo, \
-                 reconstruct_arginfo, string_escape, split_logical_lines, Dispatcher
+                 reconstruct_arginfo, string_escape, split_logical_lines, Dispatcher, node_kind, \
+                 NodeStream, ASTVisitor, TreeWalker
 from util import say_get_code
 
 from operator import itemgetter
-from StringIO import StringIO
 
 import magic
 magic.fake_package(b"renpy")
@@ -41,12 +41,30 @@ __all__ = ["astdump", "codegen", "magic", "screendecompiler", "sl2decompiler", "
 # Main API
 
 def pprint(out_file, ast, indent_level=0,
-           decompile_python=False, printlock=None, translator=None, init_offset=False):
-    Decompiler(out_file, printlock=printlock,
-               decompile_python=decompile_python, translator=translator).dump(ast, indent_level, init_offset)
+           decompile_python=False, printlock=None, translator=None, init_offset=False, profiler=None):
+    Decompiler(out_file, printlock=printlock, decompile_python=decompile_python,
+               translator=translator, profiler=profiler).dump(ast, indent_level, init_offset)
 
 # Implementation
 
+class InitOffsetVotes(ASTVisitor):
+    """
+    Counts for every init offset how many of the init blocks at the top level would not
+    need a priority with it.
+    """
+
+    def __init__(self, decompiler):
+        self.decompiler = decompiler
+        self.votes = {}
+
+    def leave(self, ast, depth):
+        if depth or node_kind(ast) != "renpy.ast.Init":
+            return
+        offset = ast.priority
+        if len(ast.block) == 1 and not self.decompiler.should_come_before(ast, ast.block[0]):
+            offset -= self.decompiler.implicit_init_priority(ast.block[0]) or 0
+        self.votes[offset] = self.votes.get(offset, 0) + 1
+
 class Decompiler(DecompilerBase):
     """
     An object which hanldes the decompilation of renpy asts to a given stream
@@ -57,8 +75,8 @@ class Decompiler(DecompilerBase):
     dispatch = Dispatcher()
 
     def __init__(self, out_file=None, decompile_python=False,
-                 indentation = '    ', printlock=None, translator=None):
-        super(Decompiler, self).__init__(out_file, indentation, printlock)
+                 indentation = '    ', printlock=None, translator=None, profiler=None):
+        super(Decompiler, self).__init__(out_file, indentation, printlock, profiler)
         self.decompile_python = decompile_python
         self.translator = translator
 
@@ -69,21 +87,31 @@ class Decompiler(DecompilerBase):
         self.missing_init = False
         self.init_offset = 0
         self.is_356c6e34_or_later = False
+        # A NodeStream that still has to be checked for is_356c6e34_or_later
+        self.unchecked_stream = None
 
     def dump(self, ast, indent_level=0, init_offset=False):
-        if (isinstance(ast, (tuple, list)) and len(ast) > 1 and
-            isinstance(ast[-1], renpy.ast.Return) and
-            (not hasattr(ast[-1], 'expression') or ast[-1].expression is None) and
-            ast[-1].linenumber == ast[-2].linenumber):
-            # A very crude version check, but currently the best we can do.
-            # Note that this commit first appears in the 6.99 release.
+        if isinstance(ast, NodeStream) and (self.translator or init_offset):
+            # These have to look at all statements before printing any of them
+            ast = list(ast)
+        if isinstance(ast, NodeStream):
+            # Checking a stream takes an extra unpickling of its tail, so only do so once the result is needed.
+            self.unchecked_stream = ast
+        elif self.ends_like_356c6e34(ast):
             self.is_356c6e34_or_later = True
 
+        # Translating and picking the init offset are done in a single walk over the AST.
+        # Picking the init offset only looks at the top level.
+        visitors = []
         if self.translator:
-            self.translator.translate_dialogue(ast)
-
+            visitors.append(self.translator)
+        if init_offset and isinstance(ast, (tuple, list)):
+            votes = InitOffsetVotes(self)
+            visitors.append(votes)
+        if visitors:
+            TreeWalker(visitors, None if self.translator else 0).walk(ast)
         if init_offset and isinstance(ast, (tuple, list)):
-            self.set_best_init_offset(ast)
+            self.set_init_offset_by_votes(votes.votes)
 
         # skip_indent_until_write avoids an initial blank line
         super(Decompiler, self).dump(ast, indent_level, skip_indent_until_write=True)
@@ -91,19 +119,36 @@ class Decompiler(DecompilerBase):
         for m in self.blank_line_queue:
             m(None)
         self.write("\n# Decompiled by unrpyc: https://github.com/CensoredUsername/unrpyc\n")
+        self.out_file.flush()
         assert not self.missing_init, "A required init, init label, or translate block was missing"
 
+    def ends_like_356c6e34(self, ast):
+        # A very crude version check, but currently the best we can do.
+        # Note that this commit first appears in the 6.99 release.
+        try:
+            last, second_last = ast[-1], ast[-2]
+        except (TypeError, IndexError):
+            return False
+        return (isinstance(last, renpy.ast.Return) and
+                (not hasattr(last, 'expression') or last.expression is None) and
+                last.linenumber == second_last.linenumber)
+
     def print_node(self, ast):
+        kind = node_kind(ast)
         # We special-case line advancement for TranslateString in its print
         # method, so don't advance lines for it here.
-        if hasattr(ast, 'linenumber') and not isinstance(ast, renpy.ast.TranslateString):
+        if hasattr(ast, 'linenumber') and kind != "renpy.ast.TranslateString":
             self.advance_to_line(ast.linenumber)
         # It doesn't matter what line "block:" is on. The loc of a RawBlock
         # refers to the first statement inside the block, which we advance
         # to from print_atl.
-        elif hasattr(ast, 'loc') and not isinstance(ast, renpy.atl.RawBlock):
+        elif hasattr(ast, 'loc') and kind != "renpy.atl.RawBlock":
             self.advance_to_line(ast.loc[1])
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+        func = self.dispatch.get(kind, type(self).print_unknown)
+        if self.profiler is None:
+            func(self, ast)
+        else:
+            self.call_handler(kind, func, ast)
 
     # ATL printing functions
 
@@ -406,12 +451,11 @@ class Decompiler(DecompilerBase):
         # If a Call block preceded us, it printed us as "from"
         if (self.index and isinstance(self.block[self.index - 1], renpy.ast.Call)):
             return
-        remaining_blocks = len(self.block) - self.index
         # See if we're the label for a menu, rather than a standalone label.
-        if remaining_blocks > 1 and not ast.block and (not hasattr(ast, 'parameters') or ast.parameters is None):
+        if self.has_next() and not ast.block and (not hasattr(ast, 'parameters') or ast.parameters is None):
             next_ast = self.block[self.index + 1]
             if (hasattr(next_ast, 'linenumber') and next_ast.linenumber == ast.linenumber and
-                (isinstance(next_ast, renpy.ast.Menu) or (remaining_blocks > 2 and
+                (isinstance(next_ast, renpy.ast.Menu) or (self.has_next(2) and
                 isinstance(next_ast, renpy.ast.Say) and
                 self.say_belongs_to_menu(next_ast, self.block[self.index + 2])))):
                 self.label_inside_menu = ast
@@ -419,10 +463,9 @@ class Decompiler(DecompilerBase):
         self.indent()
 
         # It's possible that we're an "init label", not a regular label. There's no way to know
-        # if we are until we parse our children, so temporarily redirect all of our output until
-        # that's done, so that we can squeeze in an "init " if we are.
-        out_file = self.out_file
-        self.out_file = StringIO()
+        # if we are until we parse our children, so mark where our output starts, so that we can
+        # squeeze in an "init " there once that's done if we are.
+        mark = self.out_file.mark()
         missing_init = self.missing_init
         self.missing_init = False
         try:
@@ -433,10 +476,9 @@ class Decompiler(DecompilerBase):
             self.print_nodes(ast.block, 1)
         finally:
             if self.missing_init:
-                out_file.write("init ")
+                self.out_file.insert(mark, "init ")
             self.missing_init = missing_init
-            out_file.write(self.out_file.getvalue())
-            self.out_file = out_file
+            self.out_file.release(mark)
 
     @dispatch(renpy.ast.Jump)
     def print_jump(self, ast):
@@ -468,7 +510,7 @@ class Decompiler(DecompilerBase):
     @dispatch(renpy.ast.Return)
     def print_return(self, ast):
         if ((not hasattr(ast, 'expression') or ast.expression is None) and self.parent is None and
-            self.index + 1 == len(self.block) and self.index and
+            not self.has_next() and self.index and
             ast.linenumber == self.block[self.index - 1].linenumber):
             # As of Ren'Py commit 356c6e34, a return statement is added to
             # the end of each rpyc file. Don't include this in the source.
@@ -526,21 +568,35 @@ class Decompiler(DecompilerBase):
         if not self.in_init:
             self.missing_init = True
 
-    def set_best_init_offset(self, nodes):
-        votes = {}
-        for ast in nodes:
-            if not isinstance(ast, renpy.ast.Init):
-                continue
-            offset = ast.priority
-            # Keep this block in sync with print_init
-            if len(ast.block) == 1 and not self.should_come_before(ast, ast.block[0]):
-                if isinstance(ast.block[0], renpy.ast.Screen):
-                    offset -= -500
-                elif isinstance(ast.block[0], renpy.ast.Testcase):
-                    offset -= 500
-                elif isinstance(ast.block[0], renpy.ast.Image):
-                    offset -= 500 if self.is_356c6e34_or_later else 990
-            votes[offset] = votes.get(offset, 0) + 1
+    # Statements which get an implicit init block of their own, by their default priority.
+    # Images had their default init priority changed in commit 679f9e31 (Ren'Py 6.99.10).
+    # We don't have any way of detecting this commit, though. The closest one we can
+    # detect is 356c6e34 (Ren'Py 6.99). For any versions in between these, we'll emit
+    # an unnecessary "init 990 " before image statements, but this doesn't affect the AST,
+    # and any other solution would result in incorrect code being generated in some cases.
+    implicit_init_priorities = {
+        "renpy.ast.Screen": -500,
+        "renpy.ast.Style": 0,
+        "renpy.ast.Testcase": 500,
+        "renpy.ast.Image": 990
+    }
+    # Statements which get an implicit init block with any priority
+    implicit_init_any_priority = frozenset(("renpy.ast.Define", "renpy.ast.Default", "renpy.ast.Transform"))
+
+    def implicit_init_priority(self, ast):
+        kind = node_kind(ast)
+        if kind == "renpy.ast.Image":
+            if self.unchecked_stream is not None:
+                # Reading the stream to its end keeps all of it in memory, so check its tail if we can
+                stream = self.unchecked_stream
+                tail = stream.tail() if stream.tail is not None else None
+                self.is_356c6e34_or_later = self.ends_like_356c6e34(stream if tail is None else tail)
+                self.unchecked_stream = None
+            if self.is_356c6e34_or_later:
+                return 500
+        return self.implicit_init_priorities.get(kind)
+
+    def set_init_offset_by_votes(self, votes):
         if votes:
             winner = max(votes, key=votes.get)
             # It's only worth setting an init offset if it would save
@@ -568,22 +624,10 @@ class Decompiler(DecompilerBase):
         self.in_init = True
         try:
             # A bunch of statements can have implicit init blocks
-            # Define has a default priority of 0, screen of -500 and image of 990
-            # Keep this block in sync with set_best_init_offset
             # TODO merge this and require_init into another decorator or something
             if len(ast.block) == 1 and (
-                isinstance(ast.block[0], (renpy.ast.Define,
-                                          renpy.ast.Default,
-                                          renpy.ast.Transform)) or
-                (ast.priority == -500 + self.init_offset and isinstance(ast.block[0], renpy.ast.Screen)) or
-                (ast.priority == self.init_offset and isinstance(ast.block[0], renpy.ast.Style)) or
-                (ast.priority == 500 + self.init_offset and isinstance(ast.block[0], renpy.ast.Testcase)) or
-                # Images had their default init priority changed in commit 679f9e31 (Ren'Py 6.99.10).
-                # We don't have any way of detecting this commit, though. The closest one we can
-                # detect is 356c6e34 (Ren'Py 6.99). For any versions in between these, we'll emit
-                # an unnecessary "init 990 " before image statements, but this doesn't affect the AST,
-                # and any other solution would result in incorrect code being generated in some cases.
-                (ast.priority == (500 if self.is_356c6e34_or_later else 990) + self.init_offset and isinstance(ast.block[0], renpy.ast.Image))) and not (
+                node_kind(ast.block[0]) in self.implicit_init_any_priority or
+                ast.priority - self.init_offset == self.implicit_init_priority(ast.block[0])) and not (
                 self.should_come_before(ast, ast.block[0])):
                 # If they fulfill this criteria we just print the contained statement
                 self.print_nodes(ast.block)
@@ -591,7 +635,7 @@ class Decompiler(DecompilerBase):
             # translatestring statements are split apart and put in an init block.
             elif (len(ast.block) > 0 and
                     ast.priority == self.init_offset and
-                    all(isinstance(i, renpy.ast.TranslateString) for i in ast.block) and
+                    all(node_kind(i) == "renpy.ast.TranslateString" for i in ast.block) and
                     all(i.language == ast.block[0].language for i in ast.block[1:])):
                 self.print_nodes(ast.block)
 
@@ -712,7 +756,7 @@ class Decompiler(DecompilerBase):
 
     @dispatch(renpy.ast.Say)
     def print_say(self, ast, inmenu=False):
-        if (not inmenu and self.index + 1 < len(self.block) and
+        if (not inmenu and self.has_next() and
             self.say_belongs_to_menu(ast, self.block[self.index + 1])):
             self.say_inside_menu = ast
             return
@@ -823,14 +867,14 @@ class Decompiler(DecompilerBase):
                                     self.linenumber,
                                     self.decompile_python,
                                     self.skip_indent_until_write,
-                                    self.printlock)
+                                    self.printlock, self.profiler)
             self.skip_indent_until_write = False
 
         elif isinstance(screen, renpy.sl2.slast.SLScreen):
             self.linenumber = sl2decompiler.pprint(self.out_file, screen, self.indent_level,
                                     self.linenumber,
                                     self.skip_indent_until_write,
-                                    self.printlock)
+                                    self.printlock, self.profiler)
             self.skip_indent_until_write = False
         else:
             self.print_unknown(screen)
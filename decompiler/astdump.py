@@ -22,15 +22,21 @@ from __future__ import unicode_literals
 
 import sys
 import inspect
+import json
 import codegen
 import ast as py_ast
 import renpy
+from util import node_kind, OutputBuffer, NodeStream
 
 def pprint(out_file, ast, decompile_python=False, comparable=False, no_pyexpr=False):
     # The main function of this module, a wrapper which sets
     # the config and creates the AstDumper instance
     AstDumper(out_file, decompile_python=decompile_python, comparable=comparable, no_pyexpr=no_pyexpr).dump(ast)
 
+def export(out_file, ast, decompile_python=False, comparable=False, no_pyexpr=False):
+    # Writes the ast as JSON lines, one record per node, instead of pretty printing it
+    AstExporter(out_file, decompile_python=decompile_python, comparable=comparable, no_pyexpr=no_pyexpr).dump(ast)
+
 class AstDumper(object):
     """
     An object which handles the walking of a tree of python objects
@@ -39,43 +45,68 @@ class AstDumper(object):
     """
     MAP_OPEN = {list: '[', tuple: '(', set: '{', frozenset: 'frozenset({'}
     MAP_CLOSE = {list: ']', tuple: ')', set: '}', frozenset: '})'}
+    # Types which are certainly not routines
+    PLAIN_TYPES = frozenset((unicode, str, int, bool, type(None), list, tuple, dict))
+    # The print method used for each type of object which isn't a node, filled as they're found
+    printers = {}
+    # The names of the attributes of each class which print_object could print, and the
+    # name of the class as it's printed. Like magic._class_names, these are keyed by the id
+    # of the class and store the class along with the value.
+    class_keys = {}
+    class_names = {}
 
     def __init__(self, out_file=None, decompile_python=False, no_pyexpr=False,
                  comparable=False, indentation=u'    '):
         self.indentation = indentation
-        self.out_file = out_file or sys.stdout
+        self.out_file = OutputBuffer(out_file or sys.stdout)
+        self.write = self.out_file.write
         self.decompile_python = decompile_python
         self.comparable = comparable
         self.no_pyexpr = no_pyexpr
 
     def dump(self, ast):
         self.indent = 0
-        self.passed = [] # We'll keep a stack of objects which we've traversed here so we don't recurse endlessly on circular references
+        # We'll keep the ids of the objects which we're traversing here so we don't recurse endlessly on circular references
+        self.passed = set()
         self.print_ast(ast)
+        self.out_file.flush()
 
     def print_ast(self, ast):
         # Decides which function should be used to print the given ast object.
-        if ast in self.passed:
+        key = id(ast)
+        if key in self.passed:
             self.print_other(ast)
             return
-        self.passed.append(ast)
+        self.passed.add(key)
+        kind = node_kind(ast)
+        if kind is not None:
+            # Nodes are instances of fake classes, of which only PyExpr is special
+            printer = AstDumper.print_pyexpr if kind == "renpy.ast.PyExpr" else AstDumper.print_object
+        else:
+            printer = self.printers.get(type(ast))
+            if printer is None:
+                printer = self.printers[type(ast)] = self.get_printer(ast)
+        printer(self, ast)
+        self.passed.remove(key)
+
+    def get_printer(self, ast):
+        # The method to print ast with. This only depends on the type of ast.
         if isinstance(ast, (list, tuple, set, frozenset)):
-            self.print_list(ast)
+            return AstDumper.print_list
         elif isinstance(ast, renpy.ast.PyExpr):
-            self.print_pyexpr(ast)
+            return AstDumper.print_pyexpr
         elif isinstance(ast, dict):
-            self.print_dict(ast)
+            return AstDumper.print_dict
         elif isinstance(ast, (str, unicode)):
-            self.print_string(ast)
+            return AstDumper.print_string
         elif isinstance(ast, (int, bool)) or ast is None:
-            self.print_other(ast)
+            return AstDumper.print_other
         elif inspect.isclass(ast):
-            self.print_class(ast)
+            return AstDumper.print_class
         elif isinstance(ast, object):
-            self.print_object(ast)
+            return AstDumper.print_object
         else:
-            self.print_other(ast)
-        self.passed.pop()
+            return AstDumper.print_other
 
     def print_list(self, ast):
         # handles the printing of simple containers of N elements.
@@ -105,6 +136,41 @@ class AstDumper(object):
         self.ind(-1, ast)
         self.p('}')
 
+    def get_keys(self, ast):
+        # The attributes print_object prints, which are the ones dir(ast) would list and
+        # should_print_key accepts. Whatever only depends on the class is only looked up once.
+        klass = type(ast)
+        entry = self.class_keys.get(id(klass))
+        if entry is not None and entry[0] is klass:
+            keys = entry[1]
+        else:
+            keys = frozenset(
+                i for i in dir(klass) if not i.startswith('_') and not inspect.isroutine(getattr(klass, i)))
+            self.class_keys[id(klass)] = (klass, keys)
+        if hasattr(ast, '__dict__'):
+            keys = keys.union(i for i in ast.__dict__ if not i.startswith('_'))
+        keys = sorted(keys)
+
+        if self.comparable:
+            return [i for i in keys if self.should_print_key(ast, i)]
+
+        missing = object()
+        rv = []
+        for i in keys:
+            value = getattr(ast, i, missing)
+            if value is not missing and (type(value) in self.PLAIN_TYPES or not inspect.isroutine(value)):
+                rv.append(i)
+        return rv
+
+    def get_class_name(self, klass):
+        # The start of the representation of an instance of klass, like '<renpy.ast.Say'
+        entry = self.class_names.get(id(klass))
+        if entry is not None and entry[0] is klass:
+            return entry[1]
+        name = '<' + str(klass)[8:-2]
+        self.class_names[id(klass)] = (klass, name)
+        return name
+
     def should_print_key(self, ast, key):
         if key.startswith('_') or not hasattr(ast, key) or inspect.isroutine(getattr(ast, key)):
             return False
@@ -170,8 +236,10 @@ class AstDumper(object):
         # handles the printing of anything unknown which inherts from object.
         # prints the values of relevant attributes in a dictionary-like way
         # it will not print anything which is a bound method or starts with a _
-        self.p('<')
-        self.p(str(ast.__class__)[8:-2] if hasattr(ast, '__class__')  else str(ast))
+        if hasattr(ast, '__class__'):
+            self.p(self.get_class_name(ast.__class__))
+        else:
+            self.p('<' + str(ast))
 
         if isinstance(ast, py_ast.Module) and self.decompile_python:
             self.p('.code = ')
@@ -179,14 +247,12 @@ class AstDumper(object):
             self.p('>')
             return
 
-        keys = list(i for i in dir(ast) if self.should_print_key(ast, i))
+        keys = self.get_keys(ast)
         if keys:
             self.p(' ')
         self.ind(1, keys)
         for i, key in enumerate(keys):
-            self.p('.')
-            self.p(str(key))
-            self.p(' = ')
+            self.p('.%s = ' % key)
             self.print_ast(getattr(ast, key))
             if i+1 != len(keys):
                 self.p(',')
@@ -246,5 +312,110 @@ class AstDumper(object):
             self.p(u'\n' + self.indentation * self.indent)
 
     def p(self, string):
-        # write the string to the stream
-        self.out_file.write(unicode(string))
\ No newline at end of file
+        # write the string to the stream, through a buffer that writes it in large chunks
+        self.write(string if type(string) is unicode else unicode(string))
+
+class AstExporter(AstDumper):
+    """
+    Writes a tree of python objects as JSON lines for tools which process the AST. Every node
+    (an instance of a fake Ren'Py class or a python AST node) gets a record of its own:
+
+        {"id": 2, "parent": 1, "class": "renpy.ast.Say", "linenumber": 12, "fields": {...}}
+
+    Records are written in depth-first order, so the parent of a node always comes first.
+    In the fields, child nodes are referred to as {"ref": id}. Lists, tuples and sets become
+    arrays, dicts become {"dict": [[key, value], ...]}, classes become {"class": name} and
+    PyExprs become {"pyexpr": source, "linenumber": n}. Anything else becomes {"repr": repr}.
+
+    Records are written as soon as they're created, and nothing is kept of the statements at
+    the top level once they've been written, so a stream of statements is exported in
+    constant memory.
+    """
+
+    def dump(self, ast):
+        dumps = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(',', ':')).encode
+        for record in self.records(ast):
+            self.p(dumps(record))
+            self.p('\n')
+        self.out_file.flush()
+
+    def records(self, ast):
+        # Generates the records of all nodes in ast, which is a node or a list of them
+        self.next_id = 0
+        roots = ast if isinstance(ast, (list, NodeStream)) else [ast]
+        for root in roots:
+            # References to nodes are only resolved within one top level statement, which keeps
+            # the ids of objects which were already freed out of here.
+            self.ids = {}
+            self.passed = set()
+            stack = [(self.reference(root, None), root)]
+            while stack:
+                (node_id, parent), node = stack.pop()
+                children = []
+                record = self.make_record(node, children)
+                record["id"] = node_id
+                record["parent"] = parent
+                yield record
+                stack.extend(reversed(children))
+
+    def is_node(self, ast):
+        return ((node_kind(ast) is not None and not isinstance(ast, renpy.ast.PyExpr)) or
+                isinstance(ast, py_ast.AST))
+
+    def reference(self, node, parent):
+        # Gives the node an id and the id of its parent
+        rv = self.ids[id(node)] = (self.next_id, parent)
+        self.next_id += 1
+        return rv
+
+    def make_record(self, node, children):
+        record = {"class": self.get_class_name(node.__class__)[1:]}
+
+        linenumber = getattr(node, "linenumber", None)
+        if linenumber is None:
+            location = getattr(node, "location", None) or getattr(node, "loc", None)
+            if isinstance(location, tuple) and len(location) > 1:
+                linenumber = location[1]
+        if isinstance(linenumber, int):
+            record["linenumber"] = linenumber
+
+        if isinstance(node, py_ast.Module) and self.decompile_python:
+            record["fields"] = {"code": codegen.to_source(node, unicode(self.indentation))}
+            return record
+
+        parent = self.ids[id(node)][0]
+        record["fields"] = dict((key, self.encode(getattr(node, key), parent, children))
+                                for key in self.get_keys(node))
+        return record
+
+    def encode(self, ast, parent, children):
+        # The JSON representation of a field value. Nodes in it are added to children.
+        if ast is None or isinstance(ast, (bool, int, long, float)):
+            return ast
+        elif isinstance(ast, renpy.ast.PyExpr):
+            if self.no_pyexpr:
+                return unicode(ast)
+            return {"pyexpr": unicode(ast), "linenumber": ast.linenumber}
+        elif isinstance(ast, (str, unicode)):
+            return ast
+        elif self.is_node(ast):
+            reference = self.ids.get(id(ast))
+            if reference is None:
+                reference = self.reference(ast, parent)
+                children.append((reference, ast))
+            return {"ref": reference[0]}
+        elif id(ast) in self.passed:
+            return {"repr": repr(ast)}
+
+        self.passed.add(id(ast))
+        if isinstance(ast, (list, tuple, set, frozenset)):
+            rv = [self.encode(i, parent, children) for i in ast]
+        elif isinstance(ast, dict):
+            rv = {"dict": [[self.encode(key, parent, children), self.encode(value, parent, children)]
+                           for key, value in ast.iteritems()]}
+        elif inspect.isclass(ast):
+            rv = {"class": str(ast)[8:-2]}
+        else:
+            rv = {"repr": repr(ast)}
+        self.passed.remove(id(ast))
+        return rv
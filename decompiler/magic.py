@@ -13,21 +13,40 @@ import struct
 
 if PY3:
     from io import BytesIO as StringIO
+    import copyreg
 else:
     from cStringIO import StringIO
+    import cPickle
+    import copy_reg as copyreg
 
 __all__ = [
-    "load", "loads", "safe_load", "safe_loads", "safe_dump", "safe_dumps",
+    "load", "loads", "safe_load", "safe_loads", "safe_dump", "safe_dumps", "get_safe_unpickler",
     "fake_package", "remove_fake_package",
     "FakeModule", "FakePackage", "FakePackageLoader",
     "FakeClassType", "FakeClassFactory",
-    "FakeClass", "FakeStrict", "FakeWarning", "FakeIgnore",
-    "FakeUnpicklingError", "FakeUnpickler", "SafeUnpickler",
+    "FakeClass", "FakeStrict", "FakeWarning", "FakeIgnore", "FakeCompact",
+    "FakeUnpicklingError", "FakeUnpickler", "SafeUnpickler", "FastSafeUnpickler",
     "SafePickler"
 ]
 
 # Fake class implementation
 
+CLASS_TYPES = (type, types.ClassType) if PY2 else (type,)
+
+# The names of classes and all their bases, keyed by the id of the class. Fake classes and modules
+# compare to classes by name, so with this isinstance and issubclass checks against them are a
+# single set lookup, instead of a walk over the bases which builds the name of every base.
+# The class is stored along with its names, so its id can't be reused.
+_class_names = {}
+
+def _names_of(klass):
+    entry = _class_names.get(id(klass))
+    if entry is None:
+        names = frozenset([klass.__module__ + "." + klass.__name__]).union(
+            *[_names_of(base) for base in klass.__bases__])
+        entry = _class_names[id(klass)] = (klass, names)
+    return entry[1]
+
 class FakeClassType(type):
     """
     The metaclass used to create fake classes. To support comparisons between
@@ -70,6 +89,9 @@ class FakeClassType(type):
         if "__module__" not in attributes:
             raise TypeError("No module has been specified for FakeClassType {0}".format(name))
 
+        # the name we compare by, so it doesn't have to be built for every comparison
+        attributes["_fake_name"] = attributes["__module__"] + "." + name
+
         # assemble instance
         return type.__new__(cls, name, bases, attributes)
 
@@ -79,26 +101,28 @@ class FakeClassType(type):
     # comparison logic
 
     def __eq__(self, other):
+        if isinstance(other, FakeClassType):
+            return self._fake_name == other._fake_name
         if not hasattr(other, "__name__"):
             return False
         if hasattr(other, "__module__"):
             return self.__module__ == other.__module__ and self.__name__ == other.__name__
         else:
-            return self.__module__ + "." + self.__name__ == other.__name__
+            return self._fake_name == other.__name__
 
     def __ne__(self, other):
         return not self == other
 
     def __hash__(self):
-        return hash(self.__module__ + "." + self.__name__)
+        return hash(self._fake_name)
 
     def __instancecheck__(self, instance):
-        return self.__subclasscheck__(instance.__class__)
+        return self._fake_name in _names_of(instance.__class__)
 
     def __subclasscheck__(self, subclass):
-        return (self == subclass or
-                (bool(subclass.__bases__) and
-                 any(self.__subclasscheck__(base) for base in subclass.__bases__)))
+        if not isinstance(subclass, CLASS_TYPES):
+            return self == subclass
+        return self._fake_name in _names_of(subclass)
 
 # PY2 doesn't like the PY3 way of metaclasses and PY3 doesn't support the PY2 way
 # so we call the metaclass directly
@@ -185,13 +209,76 @@ class FakeIgnore(FakeClass, object):
         if slotstate:
             self.__dict__.update(slotstate)
 
+def _attribute_name(key):
+    # With encoding="bytes", Python 3 unpickles the attribute names of Python 2 instances as bytes
+    if PY3 and isinstance(key, bytes):
+        return key.decode("utf-8")
+    return key
+
+class FakeCompact(FakeClass, object):
+    """
+    A mixin for fake classes which store the attributes of their instances in ``__slots__``
+    instead of a ``__dict__`` per instance, which takes a lot less memory. It should be
+    combined with one of :class:`FakeStrict`, :class:`FakeWarning` or :class:`FakeIgnore`.
+
+    The attributes can only be known after the first instance has been unpickled. That
+    instance gets a ``__dict__`` as usual, after which a subclass with a slot for each of its
+    attributes is created. From then on creating an instance of the class creates an instance
+    of that subclass. Attributes which don't have a slot are still stored in a ``__dict__``.
+    In Python 3, attribute names which were unpickled as bytes are decoded, as slots need
+    names which are strings.
+    """
+    _compact_class = None
+
+    def __new__(cls, *args, **kwargs):
+        return super(FakeCompact, cls).__new__(cls._compact_class or cls, *args, **kwargs)
+
+    def __setstate__(self, state):
+        cls = type(self)
+        if cls._compact_class is not cls:
+            super(FakeCompact, self).__setstate__(state)
+            if PY3:
+                # Slots need str names, the attributes of the subclass instances get them as well
+                for key in [i for i in self.__dict__ if isinstance(i, bytes)]:
+                    self.__dict__[_attribute_name(key)] = self.__dict__.pop(key)
+            if cls._compact_class is None:
+                slots = tuple(sorted(i for i in self.__dict__ if not i.startswith("__")))
+                cls._compact_class = type(cls.__name__, (cls,), {"__module__": cls.__module__,
+                                                                 "__slots__": slots})
+            return
+
+        slotstate = None
+
+        if (isinstance(state, tuple) and len(state) == 2 and
+            (state[0] is None or isinstance(state[0], dict)) and
+            (state[1] is None or isinstance(state[1], dict))):
+            state, slotstate = state
+
+        if state and not isinstance(state, dict):
+            # Let the fake class we're mixed into deal with it
+            super(FakeCompact, self).__setstate__(state)
+            state = None
+
+        for i in (state, slotstate):
+            if i:
+                for key, value in i.items():
+                    setattr(self, _attribute_name(key), value)
+
+    def __getstate__(self):
+        # Pickle as if all attributes were in __dict__
+        state = dict(self.__dict__)
+        for key in type(self).__dict__.get("__slots__", ()):
+            if hasattr(self, key):
+                state[key] = getattr(self, key)
+        return state
+
 class FakeClassFactory(object):
     """
     Factory of fake classses. It will create fake class definitions on demand
     based on the passed arguments.
     """
 
-    def __init__(self, special_cases=(), default_class=FakeStrict):
+    def __init__(self, special_cases=(), default_class=FakeStrict, compact_modules=()):
         """
         *special_cases* should be an iterable containing fake classes which should be treated
         as special cases during the fake unpickling process. This way you can specify custom methods
@@ -214,9 +301,14 @@ class FakeClassFactory(object):
 
         Alternatively they can also be instantiated using :class:`FakeClassType` directly::
            special_cases = [FakeClassType(c.__name__, c.__bases__, c.__dict__, c.__module__)]
+
+        *compact_modules* can be set to a set of strings of module names. Fake classes created
+        in these modules will also inherit from :class:`FakeCompact`, which is worthwhile when
+        there will be many instances of them.
         """
         self.special_cases = dict(((i.__module__, i.__name__), i) for i in special_cases)
         self.default = default_class
+        self.compact_modules = frozenset(compact_modules)
 
         self.class_cache = {}
 
@@ -236,13 +328,24 @@ class FakeClassFactory(object):
 
         klass = self.special_cases.get((module, name), None)
 
-        if not klass:
+        if not klass and module in self.compact_modules:
+            klass = type(name, (FakeCompact, self.default), {"__module__": module})
+        elif not klass:
             # generate a new class def which inherits from the default fake class
             klass = type(name, (self.default,), {"__module__": module})
 
         self.class_cache[(module, name)] = klass
         return klass
 
+    def preload(self, names):
+        """
+        Creates the classes for an iterable of *names* of the form ``"module.name"`` ahead of
+        time, so they're ready before the first unpickling process needs them.
+        """
+        for name in names:
+            module, name = name.rsplit(".", 1)
+            _names_of(self(name, module))
+
 # Fake module implementation
 
 class FakeModule(types.ModuleType):
@@ -325,6 +428,8 @@ class FakeModule(types.ModuleType):
         del sys.modules[self.__name__]
 
     def __eq__(self, other):
+        if isinstance(other, FakeClassType):
+            return self.__name__ == other._fake_name
         if not hasattr(other, "__name__"):
             return False
         othername = other.__name__
@@ -340,12 +445,12 @@ class FakeModule(types.ModuleType):
         return hash(self.__name__)
 
     def __instancecheck__(self, instance):
-        return self.__subclasscheck__(instance.__class__)
+        return self.__name__ in _names_of(instance.__class__)
 
     def __subclasscheck__(self, subclass):
-        return (self == subclass or
-                (bool(subclass.__bases__) and
-                 any(self.__subclasscheck__(base) for base in subclass.__bases__)))
+        if not isinstance(subclass, CLASS_TYPES):
+            return self == subclass
+        return self.__name__ in _names_of(subclass)
 
 class FakePackage(FakeModule):
     """
@@ -507,9 +612,98 @@ class SafeUnpickler(FakeUnpickler):
 
     def get_extension(self, code):
         if self.use_copyreg:
-            return FakeUnpickler.get_extension(self, code)
+            FakeUnpickler.get_extension(self, code)
         else:
-            return self.class_factory("extension_code_{0}".format(code), "copyreg")
+            # Like pickle.Unpickler.get_extension, this pushes the object instead of returning it
+            self.append(self.class_factory("extension_code_{0}".format(code), "copyreg"))
+
+class FastSafeUnpickler(object if PY2 else pickle.Unpickler):
+    """
+    A version of :class:`SafeUnpickler` built on the C unpickler, which is many times faster
+    when unpickling large object hierarchies. It takes the same arguments and creates fake
+    classes in the same way. In Python 2 this wraps a :mod:`cPickle` unpickler and hooks its
+    ``find_global`` attribute, in Python 3 this inherits from the C implementation of
+    :class:`pickle.Unpickler` and overrides :meth:`find_class`.
+
+    The C unpickler offers no way to override how extension codes are looked up. It looks
+    them up in the extension registry and passes the result to :meth:`find_class`, so they
+    will still only result in fake classes or objects from *safe_modules*. With *use_copyreg*
+    False it fails on extension codes which are not registered, so then the stream is loaded
+    again from where it started by a :class:`SafeUnpickler`, which creates fake classes for
+    them. If *file* can't seek, it's loaded by a :class:`SafeUnpickler` from the start.
+    :func:`safe_load` and :func:`safe_loads` only use this class when the extension registry
+    is empty or *use_copyreg* is True.
+
+    In Python 2 the C unpickler calls back into python for every read from a file object
+    which is not a real file or a :mod:`cStringIO` object, which wipes out most of the gain.
+    """
+    if PY2:
+        def __init__(self, file, class_factory=None, safe_modules=(),
+                     use_copyreg=False, encoding="bytes", errors="strict"):
+            self.unpickler = cPickle.Unpickler(file)
+            self.unpickler.find_global = self.find_class
+            self.file = file
+            self.class_factory = class_factory or FakeClassFactory()
+            self.safe_modules = set(safe_modules)
+            self.use_copyreg = use_copyreg
+            self.encoding = encoding
+            self.errors = errors
+
+        def _load(self):
+            return self.unpickler.load()
+    else:
+        def __init__(self, file, class_factory=None, safe_modules=(),
+                     use_copyreg=False, encoding="bytes", errors="strict"):
+            super().__init__(file, fix_imports=False, encoding=encoding, errors=errors)
+            self.file = file
+            self.class_factory = class_factory or FakeClassFactory()
+            self.safe_modules = set(safe_modules)
+            self.use_copyreg = use_copyreg
+            self.encoding = encoding
+            self.errors = errors
+
+        def _load(self):
+            return super().load()
+
+    def load(self):
+        if self.use_copyreg:
+            return self._load()
+        # Only needed to load the stream again if it contains unregistered extension codes
+        try:
+            start = self.file.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            # A stream which can't seek can't be loaded again, so leave it to SafeUnpickler
+            return self._safe_load()
+        try:
+            return self._load()
+        except ValueError as e:
+            if not str(e).startswith("unregistered extension code"):
+                raise
+        self.file.seek(start)
+        return self._safe_load()
+
+    def _safe_load(self):
+        return SafeUnpickler(self.file, self.class_factory, self.safe_modules, self.use_copyreg,
+                             encoding=self.encoding, errors=self.errors).load()
+
+    def find_class(self, module, name):
+        if module in self.safe_modules:
+            __import__(module)
+            mod = sys.modules[module]
+            klass = getattr(mod, name)
+            return klass
+
+        else:
+            return self.class_factory(name, module)
+
+def get_safe_unpickler(use_copyreg=False):
+    """
+    Returns the fastest unpickler class that keeps the restrictions of :class:`SafeUnpickler`
+    with the given *use_copyreg*.
+    """
+    if use_copyreg or not copyreg._extension_registry:
+        return FastSafeUnpickler
+    return SafeUnpickler
 
 class SafePickler(pickle.Pickler if PY2 else pickle._Pickler):
     """
@@ -565,7 +759,8 @@ def safe_load(file, class_factory=None, safe_modules=(), use_copyreg=False,
     Read a pickled object representation from the open binary :term:`file object` *file*
     and return the reconstitutded object hierarchy specified therein, substituting any
     class definitions by fake classes, ensuring safety in the unpickling process.
-    This is equivalent to ``SafeUnpickler(file).load()``.
+    This is equivalent to ``SafeUnpickler(file).load()``, but uses :class:`FastSafeUnpickler`
+    when possible.
 
     The optional keyword arguments are *class_factory*, *safe_modules*, *use_copyreg*,
     *encoding* and *errors*. *class_factory* can be used to control how the missing class
@@ -586,8 +781,8 @@ def safe_load(file, class_factory=None, safe_modules=(), use_copyreg=False,
     This function can be used to unpickle untrusted data safely with the default
     class_factory when *safe_modules* is empty and *use_copyreg* is False.
     """
-    return SafeUnpickler(file, class_factory, safe_modules, use_copyreg,
-                         encoding=encoding, errors=errors).load()
+    return get_safe_unpickler(use_copyreg)(file, class_factory, safe_modules, use_copyreg,
+                                           encoding=encoding, errors=errors).load()
 
 def safe_loads(string, class_factory=None, safe_modules=(), use_copyreg=False,
                encoding="bytes", errors="errors"):
@@ -595,8 +790,8 @@ def safe_loads(string, class_factory=None, safe_modules=(), use_copyreg=False,
     Similar to :func:`safe_load`, but takes an 8-bit string (bytes in Python 3, str in Python 2)
     as its first argument instead of a binary :term:`file object`.
     """
-    return SafeUnpickler(StringIO(string), class_factory, safe_modules, use_copyreg,
-                         encoding=encoding, errors=errors).load()
+    return get_safe_unpickler(use_copyreg)(StringIO(string), class_factory, safe_modules, use_copyreg,
+                                           encoding=encoding, errors=errors).load()
 
 def safe_dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL):
     """
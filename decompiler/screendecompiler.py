@@ -33,8 +33,8 @@ import codegen
 
 def pprint(out_file, ast, indent_level=0, linenumber=1,
            decompile_python=False,
-           skip_indent_until_write=False, printlock=None):
-    return SLDecompiler(out_file, printlock=printlock,
+           skip_indent_until_write=False, printlock=None, profiler=None):
+    return SLDecompiler(out_file, printlock=printlock, profiler=profiler,
                  decompile_python=decompile_python).dump(
                      ast, indent_level, linenumber, skip_indent_until_write)
 
@@ -50,17 +50,20 @@ class SLDecompiler(DecompilerBase):
     dispatch = Dispatcher()
 
     def __init__(self, out_file=None, decompile_python=False,
-                 indentation="    ", printlock=None):
-        super(SLDecompiler, self).__init__(out_file, indentation, printlock)
+                 indentation="    ", printlock=None, profiler=None):
+        super(SLDecompiler, self).__init__(out_file, indentation, printlock, profiler)
         self.decompile_python = decompile_python
         self.should_advance_to_line = True
         self.is_root = True
+        # Maps the nodes and the state get_lines_used_by_node was called in to its result
+        self.lines_used = {}
 
     def dump(self, ast, indent_level=0, linenumber=1, skip_indent_until_write=False):
         self.indent_level = indent_level
         self.linenumber = linenumber
         self.skip_indent_until_write = skip_indent_until_write
         self.print_screen(ast)
+        self.out_file.flush()
         return self.linenumber
 
     def advance_to_line(self, linenumber):
@@ -228,11 +231,19 @@ class SLDecompiler(DecompilerBase):
                     self.write(i[1])
 
     def get_lines_used_by_node(self, node):
-        state = self.save_state()
-        self.print_node(node[0], node[1:])
-        linenumber = self.linenumber
-        self.rollback_state(state)
-        return linenumber - self.linenumber
+        # Printing a node can measure its children in turn, and they get measured again when
+        # it's printed for real. How a node is laid out only depends on the node and on the
+        # state below, so remember the results instead of rendering subtrees over and over.
+        key = (tuple(map(id, node)), self.linenumber, self.should_advance_to_line,
+               self.skip_indent_until_write, self.is_root)
+        lines = self.lines_used.get(key)
+        if lines is None:
+            state = self.save_state()
+            self.print_node(node[0], node[1:])
+            linenumber = self.linenumber
+            self.rollback_state(state)
+            lines = self.lines_used[key] = linenumber - self.linenumber
+        return lines
 
     def print_buggy_keywords_and_nodes(self, keywords, nodes, needs_colon, has_block):
         # Keywords and child nodes can be mixed with each other, so they need
@@ -320,21 +331,22 @@ class SLDecompiler(DecompilerBase):
         dispatch_key = self.get_dispatch_key(code[0])
         if dispatch_key:
             func = self.dispatch.get(dispatch_key, self.print_python.__func__)
+            key = "sl1:%s.%s" % dispatch_key
             if has_block:
                 if func not in (self.print_onechild.__func__,
                     self.print_manychildren.__func__):
                     raise BadHasBlockException()
-                func(self, header, code, True)
+                self.call_handler(key, func, header, code, True)
             else:
-                func(self, header, code)
+                self.call_handler(key, func, header, code)
         elif has_block:
             raise BadHasBlockException()
         elif self.is_renpy_for(code):
-            self.print_for(header, code)
+            self.call_handler("sl1:for", type(self).print_for, header, code)
         elif self.is_renpy_if(code):
-            self.print_if(header, code)
+            self.call_handler("sl1:if", type(self).print_if, header, code)
         else:
-            self.print_python(header, code)
+            self.call_handler("sl1:python", type(self).print_python, header, code)
     # Helper printing functions
 
     def print_args(self, node):
@@ -23,7 +23,7 @@ import sys
 from operator import itemgetter
 
 from util import DecompilerBase, First, reconstruct_paraminfo, \
-                 reconstruct_arginfo, split_logical_lines, Dispatcher
+                 reconstruct_arginfo, split_logical_lines, Dispatcher, node_kind
 
 from renpy import ui, sl2
 from renpy.text import text
@@ -33,8 +33,8 @@ from renpy.display import layout, behavior, im, motion, dragdrop
 # Main API
 
 def pprint(out_file, ast, indent_level=0, linenumber=1,
-           skip_indent_until_write=False, printlock=None):
-    return SL2Decompiler(out_file, printlock=printlock).dump(
+           skip_indent_until_write=False, printlock=None, profiler=None):
+    return SL2Decompiler(out_file, printlock=printlock, profiler=profiler).dump(
         ast, indent_level, linenumber, skip_indent_until_write)
 
 # Implementation
@@ -50,7 +50,12 @@ class SL2Decompiler(DecompilerBase):
 
     def print_node(self, ast):
         self.advance_to_line(ast.location[1])
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+        kind = node_kind(ast)
+        func = self.dispatch.get(kind, type(self).print_unknown)
+        if self.profiler is None:
+            func(self, ast)
+        else:
+            self.call_handler(kind, func, ast)
 
     @dispatch(sl2.slast.SLScreen)
     def print_screen(self, ast):
@@ -19,7 +19,7 @@
 # SOFTWARE.
 
 from __future__ import unicode_literals
-from util import DecompilerBase, split_logical_lines, Dispatcher, string_escape
+from util import DecompilerBase, split_logical_lines, Dispatcher, string_escape, node_kind
 from renpy.test import testast
 
 # Main API
@@ -43,7 +43,7 @@ class TestcaseDecompiler(DecompilerBase):
     def print_node(self, ast):
         if hasattr(ast, 'linenumber'):
             self.advance_to_line(ast.linenumber)
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+        self.dispatch.get(node_kind(ast), type(self).print_unknown)(self, ast)
 
     @dispatch(testast.Python)
     def print_python(self, ast):
@@ -18,41 +18,44 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from util import say_get_code
-import renpy
+from util import say_get_code, node_kind, ASTVisitor, TreeWalker
 
 import hashlib
 import re
-from copy import copy
 
-class Translator(object):
+class Translator(ASTVisitor):
     def __init__(self, language, saving_translations=False):
         self.language = language
         self.saving_translations = saving_translations
         self.strings = {}
         self.dialogue = {}
         self.identifiers = set()
+        self.label = None
+        # The statements replacing those of the blocks being walked, and the translatable
+        # statements that haven't been grouped yet
+        self.new_blocks = []
 
     # Adapted from Ren'Py's Restructurer.create_translate
     def create_translate(self, block):
         if self.saving_translations:
             return [] # Doesn't matter, since we're throwing this away in this case
 
-        md5 = hashlib.md5()
+        identifier = self.unique_identifier(block)
 
-        for i in block:
-            if isinstance(i, renpy.ast.Say):
-                code = say_get_code(i)
-            elif isinstance(i, renpy.ast.UserStatement):
-                code = i.line
-            else:
-                raise Exception("Don't know how to get canonical code for a %s" % str(type(i)))
-            md5.update(code.encode("utf-8") + b"\r\n")
+        translated_block = self.dialogue.get(identifier)
+        if translated_block is None:
+            return block
 
+        old_linenumber = block[0].linenumber
+        return [overlay_linenumber(ast, old_linenumber) for ast in translated_block]
+
+    # The identifiers are computed by the walk that replaces the blocks, as it sees them, rather than
+    # in a separate pass over the file: that would walk the AST twice, and only the digests of the
+    # blocks (see block_digest) are expensive.
+    def unique_identifier(self, block):
+        base = block_digest(block)
         if self.label:
-            base = self.label + "_" + md5.hexdigest()[:8]
-        else:
-            base = md5.hexdigest()[:8]
+            base = self.label + "_" + base
 
         i = 0
         suffix = ""
@@ -68,69 +71,102 @@ class Translator(object):
             suffix = "_{0}".format(i)
 
         self.identifiers.add(identifier)
+        return identifier
 
-        translated_block = self.dialogue.get(identifier)
-        if translated_block is None:
-            return block
-
-        new_block = []
-        old_linenumber = block[0].linenumber
-        for ast in translated_block:
-            new_ast = copy(ast)
-            new_ast.linenumber = old_linenumber
-            new_block.append(new_ast)
-        return new_block
-
-    def walk(self, ast, f):
-        if isinstance(ast, (renpy.ast.Init, renpy.ast.Label, renpy.ast.While, renpy.ast.Translate, renpy.ast.TranslateBlock)):
-            f(ast.block)
-        elif isinstance(ast, renpy.ast.Menu):
-            for i in ast.items:
-                if i[2] is not None:
-                    f(i[2])
-        elif isinstance(ast, renpy.ast.If):
-            for i in ast.entries:
-                f(i[1])
-
-    # Adapted from Ren'Py's Restructurer.callback
     def translate_dialogue(self, children):
-        new_children = [ ]
-        group = [ ]
+        TreeWalker([self]).walk(children)
+
+    # Adapted from Ren'Py's Restructurer.callback, which translate_dialogue is split into
 
-        for i in children:
+    def enter_block(self, block, depth):
+        self.new_blocks.append([[ ], [ ]])
 
-            if isinstance(i, renpy.ast.Label):
-                if not (hasattr(i, 'hide') and i.hide):
-                    self.label = i.name
+    def visit(self, ast, depth):
+        kind = node_kind(ast)
 
-            if self.saving_translations and isinstance(i, renpy.ast.TranslateString) and i.language == self.language:
-                self.strings[i.old] = i.new
+        if kind == "renpy.ast.Label":
+            if not (hasattr(ast, 'hide') and ast.hide):
+                self.label = ast.name
 
-            if not isinstance(i, renpy.ast.Translate):
-                self.walk(i, self.translate_dialogue)
-            elif self.saving_translations and i.language == self.language:
-                self.dialogue[i.identifier] = i.block
+        if self.saving_translations and kind == "renpy.ast.TranslateString" and ast.language == self.language:
+            self.strings[ast.old] = ast.new
 
-            if isinstance(i, renpy.ast.Say):
-                group.append(i)
-                tl = self.create_translate(group)
-                new_children.extend(tl)
-                group = [ ]
+        if self.saving_translations and kind == "renpy.ast.Translate" and ast.language == self.language:
+            self.dialogue[ast.identifier] = ast.block
 
-            elif hasattr(i, 'translatable') and i.translatable:
-                group.append(i)
+    def leave(self, ast, depth):
+        state = self.new_blocks[-1]
+        new_children, group = state
 
-            else:
-                if group:
-                    tl = self.create_translate(group)
-                    new_children.extend(tl)
-                    group = [ ]
+        if node_kind(ast) == "renpy.ast.Say":
+            group.append(ast)
+            new_children.extend(self.create_translate(group))
+            state[1] = [ ]
+
+        elif hasattr(ast, 'translatable') and ast.translatable:
+            group.append(ast)
+
+        else:
+            if group:
+                new_children.extend(self.create_translate(group))
+                state[1] = [ ]
 
-                new_children.append(i)
+            new_children.append(ast)
+
+    def leave_block(self, block, depth):
+        new_children, group = self.new_blocks.pop()
 
         if group:
-            nodes = self.create_translate(group)
-            new_children.extend(nodes)
-            group = [ ]
+            new_children.extend(self.create_translate(group))
+
+        block[:] = new_children
+
+# The subclasses overlay_linenumber creates, by the class they subclass
+overlay_classes = {}
+
+def overlay_linenumber(ast, linenumber):
+    # Returns a stand-in for ast with a different linenumber, which shares everything else with
+    # ast instead of copying it. Its class is a subclass of the class of ast with the same name,
+    # so the decompiler treats it like ast.
+    klass = type(ast)
+    overlay_class = overlay_classes.get(klass)
+    if overlay_class is None:
+        overlay_class = overlay_classes[klass] = type(klass)(
+            klass.__name__, (klass,), {"__module__": klass.__module__, "__getattr__": overlaid_getattr})
+    rv = object.__new__(overlay_class)
+    rv.__dict__["_overlaid"] = ast
+    rv.linenumber = linenumber
+    return rv
+
+def overlaid_getattr(self, name):
+    # Only called for the attributes an overlay doesn't have itself
+    return getattr(self.__dict__["_overlaid"], name)
+
+# The digests of blocks that were seen before, by the code of their statements
+digest_cache = {}
+DIGEST_CACHE_SIZE = 10000
+
+def block_digest(block):
+    # The md5 based part of the identifier of a translatable block
+    codes = []
+    for i in block:
+        kind = node_kind(i)
+        if kind == "renpy.ast.Say":
+            codes.append(say_get_code(i))
+        elif kind == "renpy.ast.UserStatement":
+            codes.append(i.line)
+        else:
+            raise Exception("Don't know how to get canonical code for a %s" % str(type(i)))
+    codes = tuple(codes)
+
+    digest = digest_cache.get(codes)
+    if digest is None:
+        md5 = hashlib.md5()
+        for code in codes:
+            md5.update(code.encode("utf-8") + b"\r\n")
+        digest = md5.hexdigest()[:8]
 
-        children[:] = new_children
+        if len(digest_cache) >= DIGEST_CACHE_SIZE:
+            digest_cache.clear()
+        digest_cache[codes] = digest
+    return digest
@@ -1,15 +1,21 @@
 from __future__ import unicode_literals
 import sys
 import re
-from StringIO import StringIO
+import types
 from contextlib import contextmanager
 
 class DecompilerBase(object):
-    def __init__(self, out_file=None, indentation='    ', printlock=None):
-        self.out_file = out_file or sys.stdout
+    def __init__(self, out_file=None, indentation='    ', printlock=None, profiler=None):
+        # Decompilers which are handed the buffer of another decompiler share it, so their
+        # output ends up in the right place.
+        out_file = out_file or sys.stdout
+        self.out_file = out_file if isinstance(out_file, OutputBuffer) else OutputBuffer(out_file)
         self.indentation = indentation
         self.skip_indent_until_write = False
         self.printlock = printlock
+        # An object with a call(key, func, decompiler, *args) method through which every node is
+        # printed, to measure where time is spent
+        self.profiler = profiler
 
         self.linenumber = 0
 
@@ -24,9 +30,10 @@ class DecompilerBase(object):
         self.indent_level = indent_level
         self.linenumber = linenumber
         self.skip_indent_until_write = skip_indent_until_write
-        if not isinstance(ast, (tuple, list)):
+        if not isinstance(ast, (tuple, list, NodeStream)):
             ast = [ast]
         self.print_nodes(ast)
+        self.out_file.flush()
         return self.linenumber
 
     @contextmanager
@@ -41,7 +48,8 @@ class DecompilerBase(object):
         """
         Shorthand method for writing `string` to the file
         """
-        string = unicode(string)
+        if type(string) is not unicode:
+            string = unicode(string)
         self.linenumber += string.count('\n')
         self.skip_indent_until_write = False
         self.out_file.write(string)
@@ -61,25 +69,24 @@ class DecompilerBase(object):
         """
         Save our current state.
         """
-        state = (self.out_file, self.skip_indent_until_write, self.linenumber,
+        state = (self.out_file.mark(), self.skip_indent_until_write, self.linenumber,
             self.block_stack, self.index_stack, self.indent_level, self.blank_line_queue)
-        self.out_file = StringIO()
         return state
 
     def commit_state(self, state):
         """
         Commit changes since a saved state.
         """
-        out_file = state[0]
-        out_file.write(self.out_file.getvalue())
-        self.out_file = out_file
+        self.out_file.release(state[0])
 
     def rollback_state(self, state):
         """
         Roll back to a saved state.
         """
-        (self.out_file, self.skip_indent_until_write, self.linenumber,
+        (mark, self.skip_indent_until_write, self.linenumber,
             self.block_stack, self.index_stack, self.indent_level, self.blank_line_queue) = state
+        self.out_file.truncate(mark)
+        self.out_file.release(mark)
 
     def advance_to_line(self, linenumber):
         # If there was anything that we wanted to do as soon as we found a blank line,
@@ -130,6 +137,15 @@ class DecompilerBase(object):
     def index(self):
         return self.index_stack[-1]
 
+    def has_next(self, offset=1):
+        # Whether the current block contains a node offset places after the current one.
+        # This doesn't take the length of the block, as a NodeStream doesn't know it.
+        try:
+            self.block[self.index + offset]
+        except IndexError:
+            return False
+        return True
+
     @property
     def parent(self):
         if len(self.block_stack) < 2:
@@ -154,6 +170,110 @@ class DecompilerBase(object):
     def print_node(self, ast):
         raise NotImplementedError()
 
+    def call_handler(self, key, func, *args):
+        # Calls the print method func for the node identified by key
+        if self.profiler is None:
+            return func(self, *args)
+        return self.profiler.call(key, func, self, *args)
+
+class OutputBuffer(object):
+    """
+    Collects the fragments written by decompilers and writes them to `out_file` in large
+    chunks, as writing to a codecs stream is expensive per call. A mark of the current
+    position can be taken to later truncate or insert at it. While a mark is held, nothing
+    is written to `out_file`.
+    """
+
+    def __init__(self, out_file, chunk_size=4096):
+        self.out_file = out_file
+        # The amount of fragments to collect before writing them
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.marks = 0
+
+    def write(self, string):
+        parts = self.parts
+        parts.append(string)
+        if len(parts) >= self.chunk_size and not self.marks:
+            self.flush()
+
+    def flush(self):
+        if self.parts and not self.marks:
+            self.out_file.write(''.join(self.parts))
+            self.parts = []
+
+    def mark(self):
+        self.marks += 1
+        return len(self.parts)
+
+    def release(self, mark):
+        self.marks -= 1
+
+    def truncate(self, mark):
+        # Drops everything written after mark
+        del self.parts[mark:]
+
+    def insert(self, mark, string):
+        # Inserts string at mark. This moves later marks, so only do this to the last mark held.
+        self.parts.insert(mark, string)
+
+class NodeStream(object):
+    """
+    A block of nodes which are produced by an iterator while the block is being printed,
+    such as the top-level statements of a file while it is being unpickled. Only the nodes
+    near the one iteration is at are kept: nodes are read ahead when they are indexed, and
+    nodes more than `lookbehind` places before the current one are released. A negative
+    index reads the iterator to its end. If the last nodes can be produced separately, `tail`
+    is a function which returns (copies of) them, or None if it can't after all.
+    """
+
+    def __init__(self, iterable, lookbehind=2, tail=None):
+        self.iterator = iter(iterable)
+        self.lookbehind = lookbehind
+        self.tail = tail
+        # The index of the first node in self.nodes
+        self.start = 0
+        self.nodes = []
+
+    def __getitem__(self, index):
+        nodes = self.nodes
+        if index < 0:
+            nodes.extend(self.iterator)
+            index += self.start + len(nodes)
+        if index < self.start:
+            raise IndexError("node %d of the stream was already released" % index)
+        while index - self.start >= len(nodes):
+            try:
+                nodes.append(next(self.iterator))
+            except StopIteration:
+                raise IndexError("stream index out of range")
+        return nodes[index - self.start]
+
+    def __iter__(self):
+        index = 0
+        while True:
+            try:
+                node = self[index]
+            except IndexError:
+                return
+            release = index - self.lookbehind - self.start
+            if release > 0:
+                del self.nodes[:release]
+                self.start += release
+            yield node
+            index += 1
+
+def read_chunks(in_file, length=None, chunk_size=1 << 16):
+    # Yields the next length bytes of in_file, or the rest of it if length is None, in chunks
+    # of at most chunk_size bytes
+    while length != 0:
+        data = in_file.read(chunk_size if length is None else min(chunk_size, length))
+        if not data:
+            return
+        if length is not None:
+            length -= len(data)
+        yield data
+
 class First(object):
     # An often used pattern is that on the first item
     # of a loop something special has to be done. This class
@@ -241,6 +361,23 @@ KEYWORDS = set(['$', 'as', 'at', 'behind', 'call', 'expression', 'hide',
 
 word_regexp = ur'[a-zA-Z_\u00a0-\ufffd][0-9a-zA-Z_\u00a0-\ufffd]*'
 
+# The patterns used by the Lexer, compiled once instead of on every match attempt
+WHITESPACE_RE = re.compile(ur"(\s+|\\\n)+", re.DOTALL)
+PYTHON_STRING_RE = re.compile(ur"""(u?(?P<a>"|').*?(?<=[^\\])(?:\\\\)*(?P=a))""", re.DOTALL)
+NUMBER_RE = re.compile(r'(\+|\-)?(\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?', re.DOTALL)
+WORD_RE = re.compile(word_regexp, re.DOTALL)
+DOT_RE = re.compile(r'\.', re.DOTALL)
+# A single token for split_logical_lines. The alternatives are in the order the tokens have to
+# be checked in. Anything else is consumed as a run of characters without any meaning to it.
+LOGICAL_LINE_TOKEN_RE = re.compile(ur"""(?P<newline>\n)|(?P<open>[(\[{])|(?P<close>[)\]}])|"""
+                                   ur"""(?P<comment>\#[^\n]*)|"""
+                                   ur"""(?P<string>u?(?P<a>"|').*?(?<=[^\\])(?:\\\\)*(?P=a))|"""
+                                   ur"""[^\n()\[\]{}#"']+|.""", re.DOTALL)
+
+# simple_expression_guard is called for the same expressions, like character names, over and over
+simple_expression_cache = {}
+SIMPLE_EXPRESSION_CACHE_SIZE = 10000
+
 def simple_expression_guard(s):
     # Some things we deal with are supposed to be parsed by
     # ren'py's Lexer.simple_expression but actually cannot
@@ -248,12 +385,18 @@ def simple_expression_guard(s):
     # a slightly more naive approach woudl be to check
     # for spaces in it and surround it with () if necessary
     # but we're not naive
-    s = s.strip()
+    rv = simple_expression_cache.get(s)
+    if rv is not None:
+        return rv
 
-    if Lexer(s).simple_expression():
-        return s
-    else:
-        return "(%s)" % s
+    rv = s.strip()
+    if not Lexer(rv).simple_expression():
+        rv = "(%s)" % rv
+
+    if len(simple_expression_cache) >= SIMPLE_EXPRESSION_CACHE_SIZE:
+        simple_expression_cache.clear()
+    simple_expression_cache[s] = rv
+    return rv
 
 def split_logical_lines(s):
     return Lexer(s).split_logical_lines()
@@ -269,10 +412,13 @@ class Lexer(object):
     def re(self, regexp):
         # see if regexp matches at self.string[self.pos].
         # if it does, increment self.pos
+        # regexp can be a compiled pattern or a string, which will be compiled with re.DOTALL
         if self.length == self.pos:
             return None
 
-        match = re.compile(regexp, re.DOTALL).match(self.string, self.pos)
+        if isinstance(regexp, basestring):
+            regexp = re.compile(regexp, re.DOTALL)
+        match = regexp.match(self.string, self.pos)
         if not match:
             return None
 
@@ -281,20 +427,20 @@ class Lexer(object):
 
     def eol(self):
         # eat the next whitespace and check for the end of this simple_expression
-        self.re(ur"(\s+|\\\n)+")
+        self.re(WHITESPACE_RE)
         return self.pos >= self.length
 
     def match(self, regexp):
         # strip whitespace and match regexp
-        self.re(ur"(\s+|\\\n)+")
+        self.re(WHITESPACE_RE)
         return self.re(regexp)
 
     def python_string(self, clear_whitespace=True):
         # parse strings the ren'py way (don't parse docstrings, no b/r in front allowed)
         if clear_whitespace:
-            return self.match(ur"""(u?(?P<a>"|').*?(?<=[^\\])(?:\\\\)*(?P=a))""")
+            return self.match(PYTHON_STRING_RE)
         else:
-            return self.re(ur"""(u?(?P<a>"|').*?(?<=[^\\])(?:\\\\)*(?P=a))""")
+            return self.re(PYTHON_STRING_RE)
 
 
     def container(self):
@@ -324,11 +470,11 @@ class Lexer(object):
 
     def number(self):
         # parses a number, float or int (but not forced long)
-        return self.match(r'(\+|\-)?(\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+        return self.match(NUMBER_RE)
 
     def word(self):
         # parses a word
-        return self.match(word_regexp)
+        return self.match(WORD_RE)
 
     def name(self):
         # parses a word unless it's in KEYWORDS.
@@ -359,7 +505,7 @@ class Lexer(object):
         while not self.eol():
 
             # if the previous was followed by a dot, there should be a word after it
-            if self.match(r'\.'):
+            if self.match(DOT_RE):
                 if not self.name():
                     # ren'py errors here. I just stop caring
                     return False
@@ -379,43 +525,34 @@ class Lexer(object):
         # split a sequence in logical lines
         # this behaves similarly to .splitlines() which will ignore
         # a trailing \n
+        # This scans the string in a single pass of LOGICAL_LINE_TOKEN_RE, every character
+        # is part of exactly one token.
         lines = []
 
         contained = 0
 
+        string = self.string
         startpos = self.pos
 
-        while self.pos < self.length:
-            c = self.string[self.pos]
+        for token in LOGICAL_LINE_TOKEN_RE.finditer(string, self.pos):
+            kind = token.lastgroup
 
-            if c == '\n' and not contained and (not self.pos or self.string[self.pos - 1] != '\\'):
-                lines.append(self.string[startpos:self.pos])
-                # the '\n' is not included in the emitted line
-                self.pos += 1
-                startpos = self.pos
-                continue
+            if kind == "newline":
+                pos = token.start()
+                if not contained and (not pos or string[pos - 1] != '\\'):
+                    lines.append(string[startpos:pos])
+                    # the '\n' is not included in the emitted line
+                    startpos = pos + 1
 
-            if c in ('(', '[', '{'):
+            elif kind == "open":
                 contained += 1
-                self.pos += 1
-                continue
 
-            if c in (')', ']', '}') and contained:
+            elif kind == "close" and contained:
                 contained -= 1
-                self.pos += 1
-                continue
-
-            if c == '#':
-                self.re("[^\n]*")
-                continue
-
-            if self.python_string(False):
-                continue
-
-            self.re(r'\w+| +|.') # consume a word, whitespace or one symbol
 
+        self.pos = self.length
         if self.pos != startpos:
-            lines.append(self.string[startpos:])
+            lines.append(string[startpos:])
         return lines
 
 # Versions of Ren'Py prior to 6.17 put trailing whitespace on the end of
@@ -445,15 +582,86 @@ class WordConcatenator(object):
         self.needs_space = rv[-1] != ' '
         return rv
 
+def node_kind(ast):
+    """
+    Returns the name of the class of `ast`, like "renpy.ast.Say", or None if it's not a fake class.
+    Fake classes store this when they're created, so this is a lot cheaper than an isinstance check.
+    """
+    return getattr(type(ast), "_fake_name", None)
+
 # Dict subclass for aesthetic dispatching. use @Dispatcher(data) to dispatch
+# Classes of the fake renpy package are stored by name, so they can be looked up by node_kind
 class Dispatcher(dict):
     def __call__(self, name):
         def closure(func):
-            self[name] = func
+            self[name.__name__ if isinstance(name, types.ModuleType) else name] = func
             return func
         return closure
 
+class ASTVisitor(object):
+    """
+    Base class for the analyses a TreeWalker runs. For every block, enter_block is called
+    before its statements are visited and leave_block after. For every statement, visit is
+    called before the blocks nested in it are walked and leave after.
+    `depth` is 0 for the statements of the block the walk started at.
+    """
+
+    def enter_block(self, block, depth):
+        pass
+
+    def visit(self, ast, depth):
+        pass
+
+    def leave(self, ast, depth):
+        pass
+
+    def leave_block(self, block, depth):
+        pass
+
+class TreeWalker(object):
+    """
+    Walks the blocks of statements in a Ren'Py AST once for several visitors, so analyses of
+    the AST don't each need their own pass over it. Blocks nested deeper than `max_depth` aren't
+    walked. The blocks of translate statements aren't walked either, as they hold translations
+    of the statements before them.
+    """
+    # Statements which contain a block of statements
+    block_kinds = frozenset(("renpy.ast.Init", "renpy.ast.Label", "renpy.ast.While",
+                             "renpy.ast.TranslateBlock"))
+
+    def __init__(self, visitors, max_depth=None):
+        self.visitors = visitors
+        self.max_depth = max_depth
+
+    def nested_blocks(self, ast):
+        kind = node_kind(ast)
+        if kind in self.block_kinds:
+            return (ast.block,)
+        elif kind == "renpy.ast.Menu":
+            return [i[2] for i in ast.items if i[2] is not None]
+        elif kind == "renpy.ast.If":
+            return [i[1] for i in ast.entries]
+        return ()
+
+    def walk(self, block, depth=0):
+        visitors = self.visitors
+        descend = self.max_depth is None or depth < self.max_depth
+        for visitor in visitors:
+            visitor.enter_block(block, depth)
+        for ast in block:
+            for visitor in visitors:
+                visitor.visit(ast, depth)
+            if descend:
+                for nested in self.nested_blocks(ast):
+                    self.walk(nested, depth + 1)
+            for visitor in visitors:
+                visitor.leave(ast, depth)
+        for visitor in visitors:
+            visitor.leave_block(block, depth)
+
 # ren'py string handling
+SAY_SPACE_RE = re.compile(r'(?<= ) ')
+
 def encode_say_string(s):
     """
     Encodes a string in the format used by Ren'Py say statements.
@@ -462,19 +670,30 @@ def encode_say_string(s):
     s = s.replace("\\", "\\\\")
     s = s.replace("\n", "\\n")
     s = s.replace("\"", "\\\"")
-    s = re.sub(r'(?<= ) ', '\\ ', s)
+    s = SAY_SPACE_RE.sub('\\ ', s)
 
     return "\"" + s + "\""
 
+# The code of say statements, by everything the code is made of. Both the decompiler and the
+# translator need the code of the same statements.
+say_code_cache = {}
+SAY_CODE_CACHE_SIZE = 10000
+
 # Adapted from Ren'Py's Say.get_code
 def say_get_code(ast, inmenu=False):
+    attributes = getattr(ast, 'attributes', None)
+    key = (ast.who, None if attributes is None else tuple(attributes), ast.what, ast.interact, ast.with_, inmenu)
+    rv = say_code_cache.get(key)
+    if rv is not None:
+        return rv
+
     rv = [ ]
 
     if ast.who:
         rv.append(ast.who)
 
-    if hasattr(ast, 'attributes') and ast.attributes is not None:
-        rv.extend(ast.attributes)
+    if attributes is not None:
+        rv.extend(attributes)
 
     # no dialogue_filter applies to us
 
@@ -487,4 +706,8 @@ def say_get_code(ast, inmenu=False):
         rv.append("with")
         rv.append(ast.with_)
 
-    return " ".join(rv)
+    rv = " ".join(rv)
+    if len(say_code_cache) >= SAY_CODE_CACHE_SIZE:
+        say_code_cache.clear()
+    say_code_cache[key] = rv
+    return rv
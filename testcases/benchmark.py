@@ -0,0 +1,309 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2012 Yuri K. Schlesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Benchmark of the decompilation pipeline. It generates synthetic .rpyc files
+# containing a bit of everything (labels, dialogue, menus, ATL, SL1 and SL2
+# screens and translate blocks), or takes existing .rpyc files, and times each
+# stage of decompiling them separately. The results are written as JSON.
+
+import argparse
+import ast as py_ast
+import codecs
+import json
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from os import path
+from StringIO import StringIO
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import unrpyc
+import decompiler
+from decompiler import magic
+
+STAGES = ("container", "inflate", "unpickle", "decompile", "write")
+
+# Synthetic script generation
+
+class PyCode(magic.FakeStrict):
+    # The PyCode of unrpyc only knows how to load the state Ren'Py pickles, so provide it.
+    __module__ = "renpy.ast"
+
+    def __getstate__(self):
+        return (1, self.source, self.location, self.mode)
+
+class ScriptGenerator(object):
+    """
+    Builds the AST of a synthetic script out of fake Ren'Py classes. Every statement
+    is put on its own line, so the decompiled output looks like a normal script.
+    """
+
+    def __init__(self, filename="game/benchmark.rpy"):
+        self.filename = filename
+        self.linenumber = 1
+        self.serial = 0
+
+    def line(self, advance=1):
+        rv = self.linenumber
+        self.linenumber += advance
+        return rv
+
+    def node(self, classname, module="renpy.ast", **attributes):
+        rv = unrpyc.class_factory(classname, module)()
+        rv.__dict__.update(attributes)
+        return rv
+
+    def statement(self, classname, **attributes):
+        self.serial += 1
+        # Labels store their own name where other statements store their serial
+        attributes.setdefault("name", (self.filename, 0, self.serial))
+        if "linenumber" not in attributes:
+            attributes["linenumber"] = self.line()
+        return self.node(classname, filename=self.filename, next=None, **attributes)
+
+    def expr(self, source, linenumber=None):
+        return unrpyc.PyExpr(source, self.filename, linenumber or self.linenumber)
+
+    def code(self, source, linenumber, mode="exec"):
+        rv = PyCode()
+        rv.__dict__.update(source=source, location=(self.filename, linenumber), mode=mode)
+        return rv
+
+    def say(self, who, what):
+        return self.statement("Say", who=who, what=what, with_=None, interact=True, attributes=None)
+
+    def atl(self):
+        linenumber = self.line()
+        statements = [self.node("RawMultipurpose", "renpy.atl", loc=(self.filename, linenumber),
+                                warper="linear", warp_function=None, duration="0.5",
+                                revolution=None, circles="0", splines=[], expressions=[],
+                                properties=[("xalign", "0.5"), ("yalign", "1.0")])]
+        return self.node("RawBlock", "renpy.atl", loc=(self.filename, linenumber), statements=statements, animation=False)
+
+    def label(self, i, says_per_label):
+        label = self.statement("Label", name="label_%d" % i, block=[], parameters=None, hide=False)
+        block = label.block
+
+        show = self.statement("Show", imspec=(("eileen", "happy"), None, None, [], None, None, []))
+        show.atl = self.atl()
+        block.append(show)
+
+        for j in range(says_per_label):
+            block.append(self.say("e" if j % 2 else None, "Line %d of label %d, with a \"quote\"." % (j, i)))
+
+        block.append(self.statement("Python", code=self.code("points_%d = %d" % (i, i), self.linenumber),
+                                    hide=False, store="store"))
+
+        menu = self.statement("Menu", items=[], set=None, with_=None)
+        self.line()
+        menu.items.append(("Go on to %d" % (i + 1), "True",
+                           [self.statement("Jump", target="label_%d" % (i + 1), expression=False)]))
+        linenumber = self.line()
+        menu.items.append(("Stay at %d" % i, self.expr("points_%d > 1" % i, linenumber),
+                           [self.say("e", "Staying a while.")]))
+        block.append(menu)
+
+        block.append(self.statement("Jump", target="label_%d" % (i + 1), expression=False))
+        self.line()
+        return label
+
+    def screen(self, screen, linenumber):
+        init = self.statement("Init", priority=-500, linenumber=linenumber)
+        init.block = [self.statement("Screen", screen=screen, linenumber=linenumber)]
+        return init
+
+    def sl2_screen(self, i):
+        location = (self.filename, self.line())
+        vbox_line = self.line()
+        children = [
+            self.node("SLDisplayable", "renpy.sl2.slast",
+                      displayable=unrpyc.class_factory("Text", "renpy.text.text"), style="text",
+                      positional=['"Hello %d"' % i], keyword=[], children=[],
+                      location=(self.filename, self.line())),
+            self.node("SLDisplayable", "renpy.sl2.slast",
+                      displayable=unrpyc.class_factory("_textbutton", "renpy.ui"), style=0,
+                      positional=['"Go"'], children=[], location=(self.filename, self.linenumber),
+                      keyword=[("action", self.expr("Jump('label_%d')" % i, self.line()))])
+        ]
+        vbox = self.node("SLDisplayable", "renpy.sl2.slast",
+                         displayable=unrpyc.class_factory("MultiBox", "renpy.display.layout"), style="vbox",
+                         positional=[], keyword=[("spacing", self.expr("5", vbox_line))], children=children,
+                         location=(self.filename, vbox_line))
+        self.line()
+        return self.screen(self.node(
+            "SLScreen", "renpy.sl2.slast", name="sl2_screen_%d" % i, parameters=None, tag=None,
+            keyword=[], children=[vbox], location=location), location[1])
+
+    def sl1_screen(self, i):
+        linenumber = self.line()
+        # Screen language 1 screens are stored as the python code the screen compiled to.
+        # Parse it with enough blank lines in front that its line numbers match ours.
+        source = "\n".join((
+            "_1 = (_name, 0); ui.vbox(id=_1, scope=_scope, spacing=5)",
+            "_2 = (_1, 0); ui.text('Hello %d', id=_2, scope=_scope)" % i,
+            "_3 = (_1, 1); ui.textbutton('Go', id=_3, scope=_scope, action=Jump('label_%d'))" % i,
+            "ui.close()"))
+        code = py_ast.parse("\n" * linenumber + source)
+        self.line(4)
+        return self.screen(self.node(
+            "ScreenLangScreen", "renpy.screenlang", name="sl1_screen_%d" % i, tag=None,
+            modal="False", zorder="0", variant="None", predict="None",
+            code=self.code(code, linenumber)), linenumber)
+
+    def translate(self, i):
+        translate = self.statement("Translate", identifier="label_%d_%08x" % (i, i), language="french")
+        translate.block = [self.say("e", "Ligne traduite %d." % i)]
+        self.line()
+        return translate
+
+    def generate(self, labels, says_per_label=8, screen_every=10):
+        stmts = []
+        for i in range(labels):
+            stmts.append(self.label(i, says_per_label))
+            if i % screen_every == 0:
+                stmts.append(self.sl2_screen(i))
+                stmts.append(self.sl1_screen(i))
+        for i in range(labels):
+            stmts.append(self.translate(i))
+        return stmts
+
+def write_rpyc(out_filename, stmts):
+    payload = zlib.compress(magic.safe_dumps(({"version": 5003000, "key": "benchmark"}, stmts)))
+    header_length = 10 + 3 * 12
+    with open(out_filename, "wb") as out_file:
+        out_file.write("RENPY RPC2")
+        out_file.write(struct.pack("III", 1, header_length, len(payload)))
+        out_file.write(struct.pack("III", 2, header_length + len(payload), 0))
+        out_file.write(struct.pack("III", 0, 0, 0))
+        out_file.write(payload)
+
+# Benchmarking
+
+def time_stages(input_filename, out_filename, init_offset=False):
+    timings = {}
+    start = time.time()
+
+    with open(input_filename, "rb") as in_file:
+        chunk_start, length = unrpyc.find_rpyc_chunk(in_file)
+        in_file.seek(chunk_start)
+        raw_contents = in_file.read() if length is None else in_file.read(length)
+    timings["container"] = time.time() - start; start = time.time()
+
+    raw_contents = zlib.decompress(raw_contents)
+    timings["inflate"] = time.time() - start; start = time.time()
+
+    data, stmts = magic.safe_loads(raw_contents, unrpyc.class_factory, {"_ast"})
+    timings["unpickle"] = time.time() - start; start = time.time()
+
+    out_file = StringIO()
+    decompiler.pprint(out_file, stmts, init_offset=init_offset)
+    timings["decompile"] = time.time() - start; start = time.time()
+
+    with codecs.open(out_filename, "w", encoding="utf-8") as f:
+        f.write(out_file.getvalue())
+    timings["write"] = time.time() - start
+
+    return timings, len(raw_contents)
+
+def benchmark(input_filename, out_filename, repeat, init_offset=False):
+    runs = []
+    for i in range(repeat):
+        timings, inflated_size = time_stages(input_filename, out_filename, init_offset)
+        runs.append(timings)
+
+    stages = {}
+    for stage in STAGES:
+        times = [run[stage] for run in runs]
+        stages[stage] = {"min": min(times), "mean": sum(times) / len(times)}
+    return {
+        "file": input_filename,
+        "size": path.getsize(input_filename),
+        "inflated_size": inflated_size,
+        "stages": stages
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of decompiling .rpyc files")
+
+    parser.add_argument('-l', '--labels', dest='labels', type=int, default=2000,
+                        help="the amount of labels in each synthetic script")
+
+    parser.add_argument('-n', '--files', dest='files', type=int, default=1,
+                        help="the amount of synthetic scripts to generate")
+
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help="how often to decompile every file")
+
+    parser.add_argument('-o', '--output', dest='output', action='store', default=None,
+                        help="write the results to the specified file instead of stdout")
+
+    parser.add_argument('-k', '--keep', dest='keep', action='store', default=None,
+                        help="generate the synthetic scripts in the specified directory and keep them")
+
+    parser.add_argument('--init-offset', dest='init_offset', action='store_true',
+                        help="decompile with --init-offset")
+
+    parser.add_argument('file', type=str, nargs='*',
+                        help="existing .rpyc files to benchmark instead of synthetic scripts")
+
+    args = parser.parse_args()
+
+    workdir = args.keep or tempfile.mkdtemp(prefix="unrpyc-benchmark-")
+    if not path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        files = args.file
+        if not files:
+            for i in range(args.files):
+                filename = path.join(workdir, "benchmark%d.rpyc" % i)
+                write_rpyc(filename, ScriptGenerator().generate(args.labels))
+                files.append(filename)
+
+        results = []
+        for filename in files:
+            out_filename = path.join(workdir, path.splitext(path.basename(filename))[0] + ".rpy")
+            results.append(benchmark(filename, out_filename, args.repeat, args.init_offset))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    report = {
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "files": results,
+        "totals": dict((stage, sum(i["stages"][stage]["min"] for i in results)) for stage in STAGES)
+    }
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(report, out_file, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print
+
+if __name__ == '__main__':
+    main()
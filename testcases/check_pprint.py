@@ -0,0 +1,61 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2012 Yuri K. Schlesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Checks that the pprint functions of the screen decompilers write their output to a plain file
+# when they are called on their own instead of from the main decompiler.
+
+import sys
+from os import path
+from StringIO import StringIO
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from benchmark import ScriptGenerator
+from decompiler import screendecompiler, sl2decompiler
+
+EXPECTED_SL1 = (u"\n"
+                u"screen sl1_screen_0:\n"
+                u"    vbox spacing 5:\n"
+                u"        text 'Hello 0'\n"
+                u"        textbutton 'Go' action Jump('label_0')")
+
+EXPECTED_SL2 = (u"\n\n\n\n\n"
+                u"screen sl2_screen_0:\n"
+                u"    vbox spacing 5:\n"
+                u"        text \"Hello 0\"\n"
+                u"        textbutton \"Go\" action Jump('label_0')")
+
+def main():
+    generator = ScriptGenerator()
+    failed = False
+    for name, module, init, expected in (
+            ("screendecompiler", screendecompiler, generator.sl1_screen(0), EXPECTED_SL1),
+            ("sl2decompiler", sl2decompiler, generator.sl2_screen(0), EXPECTED_SL2)):
+        out_file = StringIO()
+        module.pprint(out_file, init.block[0].screen)
+        if out_file.getvalue() != expected:
+            print "%s.pprint wrote %r instead of %r" % (name, out_file.getvalue(), expected)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2012 Yuri K. Schlesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Packs files into a Ren'Py archive (RPA-3.0), like the archives Ren'Py builds, so that reading
+# .rpyc files from archives can be tested without shipping one.
+
+import argparse
+import cPickle as pickle
+import zlib
+
+# The key the offsets and lengths in the index are obfuscated with
+KEY = 0x42424242
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack files into a Ren'Py archive.")
+    parser.add_argument('archive', help="The archive to write.")
+    parser.add_argument('files', nargs='+', metavar='name=file',
+                        help="The files to pack, and the names they have in the archive.")
+    parser.add_argument('--parts', type=int, default=1,
+                        help="Split every file into this many parts, like very old versions of Ren'Py did.")
+    args = parser.parse_args()
+
+    with open(args.archive, 'wb') as archive:
+        # The header is written last, once the offset of the index is known
+        archive.write(b'\0' * 34)
+        index = {}
+        for i in args.files:
+            name, filename = i.split('=', 1)
+            with open(filename, 'rb') as f:
+                data = f.read()
+            parts = []
+            size = -(-len(data) // args.parts)
+            for start in range(0, len(data), size):
+                part = data[start:start + size]
+                parts.append((archive.tell() ^ KEY, len(part) ^ KEY))
+                archive.write(part)
+            index[name.decode('utf-8')] = parts
+
+        index_offset = archive.tell()
+        archive.write(zlib.compress(pickle.dumps(index, pickle.HIGHEST_PROTOCOL)))
+        archive.seek(0)
+        archive.write(b'RPA-3.0 %016x %08x\n' % (index_offset, KEY))
+
+if __name__ == '__main__':
+    main()
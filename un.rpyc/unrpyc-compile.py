@@ -23,9 +23,11 @@ import os.path as path
 import codecs
 import traceback
 import struct
+import zlib
 
 import decompiler
 import magic
+from util import read_chunks
 
 # special new and setstate methods for special classes
 
@@ -47,22 +49,23 @@ factory = magic.FakeClassFactory((PyExpr, PyCode), magic.FakeStrict)
 
 def read_ast_from_file(in_file):
     # .rpyc files are just zlib compressed pickles of a tuple of some data and the actual AST of the file
-    raw_contents = in_file.read()
-    if raw_contents.startswith("RENPY RPC2"):
-        # parse the archive structure
-        position = 10
-        chunks = {}
+    # Only the slot table of the RPC2 container is parsed. The slot is inflated a chunk at a time,
+    # so the compressed data is never held in memory as a whole.
+    start, length = 0, None
+    if in_file.read(10) == b"RENPY RPC2":
         while True:
-            slot, start, length = struct.unpack("III", raw_contents[position: position + 12])
-            if slot == 0:
+            slot, start, length = struct.unpack("III", in_file.read(12))
+            if slot == 1:
                 break
-            position += 12
+            if slot == 0:
+                raise ValueError("RPC2 file does not contain an AST slot")
+    in_file.seek(start)
 
-            chunks[slot] = raw_contents[start: start + length]
+    decompressor = zlib.decompressobj()
+    parts = [decompressor.decompress(data) for data in read_chunks(in_file, length)]
+    parts.append(decompressor.flush())
 
-        raw_contents = chunks[1]
-    raw_contents = raw_contents.decode('zlib')
-    data, stmts = magic.safe_loads(raw_contents, factory, ("_ast",))
+    data, stmts = magic.safe_loads(b"".join(parts), factory, ("_ast",))
     return stmts
 
 def ensure_dir(filename):
@@ -21,17 +21,40 @@
 # SOFTWARE.
 
 import argparse
+import os
+import sys
 from os import path, walk
 import codecs
 import glob
 import itertools
 import traceback
 import struct
+import hashlib
+import json
+import base64
+import socket
+import threading
+import signal
+import stat
+import zlib
+import mmap
+import time
+import gc
+import cProfile
+import pickle
+import pickletools
+import array
+import shutil
+import tempfile
 from multiprocessing import Pool, Lock, cpu_count
 from operator import itemgetter
+from collections import deque
+from cStringIO import StringIO
+from contextlib import contextmanager
 
 import decompiler
 from decompiler import magic, astdump, translate
+from decompiler.util import NodeStream, read_chunks
 
 # special definitions for special classes
 
@@ -52,38 +75,602 @@ class PyCode(magic.FakeStrict):
         (_, self.source, self.location, self.mode) = state
         self.bytecode = None
 
-class_factory = magic.FakeClassFactory((PyExpr, PyCode), magic.FakeStrict)
+# The nodes of big scripts number in the hundreds of thousands, so store their attributes in slots
+class_factory = magic.FakeClassFactory((PyExpr, PyCode), magic.FakeStrict,
+                                       {"renpy.ast", "renpy.atl", "renpy.sl2.slast"})
+# Create the classes of all nodes the decompilers know about up front
+class_factory.preload(itertools.chain(decompiler.Decompiler.dispatch,
+                                      decompiler.sl2decompiler.SL2Decompiler.dispatch,
+                                      decompiler.testcasedecompiler.TestcaseDecompiler.dispatch))
 
 printlock = Lock()
 
+# The contents of the translation file passed with -t. This is loaded once per process
+# instead of once for every file.
+translations = None
+
 # API
 
-def read_ast_from_file(in_file):
+def inflate(in_file, length=None):
+    # Inflates the zlib compressed data at the current position of in_file. length is the
+    # amount of compressed bytes, or None to read until the end of the file. The compressed
+    # data is read a chunk at a time, and the inflated data is added to a single bytearray,
+    # so it's only held in memory once.
+    decompressor = zlib.decompressobj()
+    contents = bytearray()
+    for data in read_chunks(in_file, length):
+        contents += decompressor.decompress(data)
+    contents += decompressor.flush()
+    return contents
+
+class MappedReader(object):
+    """
+    Reads from a memory mapped file without copying anything. Every read returns a buffer
+    object which refers to the mapping, which zlib can inflate directly.
+    """
+    def __init__(self, mapping, position=0):
+        self.mapping = mapping
+        self.position = position
+
+    def read(self, size):
+        size = max(0, min(size, len(self.mapping) - self.position))
+        rv = buffer(self.mapping, self.position, size)
+        self.position += size
+        return rv
+
+class ArchiveEntry(str):
+    """
+    A .rpyc file stored in a Ren'Py archive (.rpa). Its value is the path the file would have if
+    the archive were extracted where it is, so it can be used in place of the filename of a .rpyc
+    file, except that it has to be opened with open_rpyc. Its data is the concatenation of its
+    *parts*, a list of (offset, length, prefix) tuples, each of which stands for *prefix*
+    followed by ``length - len(prefix)`` bytes at *offset* in the archive. Nearly all entries
+    have a single part, only archives written by very old versions of Ren'Py split them up.
+    """
+    def __new__(cls, archive, name, parts):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self = str.__new__(cls, path.normpath(path.join(path.dirname(archive), name)))
+        self.archive = archive
+        self.name = name
+        self.parts = parts
+        self.length = sum(length for offset, length, prefix in parts)
+        return self
+
+    def __reduce__(self):
+        return (ArchiveEntry, (self.archive, self.name, self.parts))
+
+class ArchiveEntryFile(object):
+    """
+    A read-only file-like object over the data of an ArchiveEntry, which reads it from
+    *in_file*, the open archive, as it's requested.
+    """
+    def __init__(self, in_file, entry):
+        self.in_file = in_file
+        self.length = entry.length
+        self.position = 0
+        # Every part, with the position in the entry at which it starts
+        self.parts = []
+        start = 0
+        for part in entry.parts:
+            self.parts.append((start, part))
+            start += part[1]
+
+    def seek(self, position):
+        self.position = position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.length if size < 0 else min(self.length, self.position + size)
+        chunks = []
+        for start, (offset, length, prefix) in self.parts:
+            if self.position >= end:
+                break
+            if self.position >= start + length:
+                continue
+            # The range to read, relative to the start of the part
+            position, part_end = self.position - start, min(end - start, length)
+            if position < len(prefix):
+                chunks.append(prefix[position:part_end])
+                position = min(part_end, len(prefix))
+            if position < part_end:
+                self.in_file.seek(offset + position - len(prefix))
+                chunks.append(self.in_file.read(part_end - position))
+            self.position = start + part_end
+        return b"".join(chunks)
+
+def read_archive_index(archive_filename):
+    # Returns the ArchiveEntries of the .rpyc files in a Ren'Py archive. Only the index is read,
+    # which is a zlib compressed pickle of a dict of filename -> [(offset, length[, prefix])].
+    # In RPA-3.0 archives the offsets and lengths are obfuscated by xoring them with a key.
+    with open(archive_filename, 'rb') as archive:
+        header = archive.readline().split()
+        if header[:1] == [b"RPA-3.0"]:
+            offset, key = int(header[1], 16), int(header[2], 16)
+        elif header[:1] == [b"RPA-2.0"]:
+            offset, key = int(header[1], 16), 0
+        else:
+            raise ValueError("%s is not a supported Ren'Py archive" % archive_filename)
+        archive.seek(offset)
+        index = magic.safe_loads(zlib.decompress(archive.read()), class_factory)
+
+    # The names come from the game, so don't trust them to stay inside the directory of the archive
+    base = path.join(path.abspath(path.dirname(archive_filename)), '')
+    entries = []
+    for name, parts in index.iteritems():
+        if not name.endswith('.rpyc'):
+            continue
+        parts = [(part[0] ^ key, part[1] ^ key, part[2] if len(part) > 2 else b"") for part in parts]
+        entry = ArchiveEntry(archive_filename, name, parts)
+        if path.isabs(entry.name) or not path.abspath(entry).startswith(base):
+            with printlock:
+                print "Skipping %s in %s: it would be written outside of the directory of the archive" % (
+                    entry.name, archive_filename)
+            continue
+        entries.append(entry)
+    return entries
+
+@contextmanager
+def open_rpyc(input_filename):
+    # Opens a .rpyc file, or the ArchiveEntry passed instead of its filename, for reading
+    if isinstance(input_filename, ArchiveEntry):
+        with open(input_filename.archive, 'rb') as archive:
+            yield ArchiveEntryFile(archive, input_filename)
+    else:
+        with open(input_filename, 'rb') as in_file:
+            yield in_file
+
+def get_input_size(input_filename):
+    if isinstance(input_filename, ArchiveEntry):
+        return input_filename.length
+    return path.getsize(input_filename)
+
+def find_rpyc_chunk(in_file, slot=1):
     # .rpyc files are just zlib compressed pickles of a tuple of some data and the actual AST of the file
-    raw_contents = in_file.read()
-    if raw_contents.startswith("RENPY RPC2"):
-        # parse the archive structure
-        position = 10
-        chunks = {}
+    # Newer ones wrap these in an RPC2 container. This only parses the slot table of the container
+    # and returns the offset and length of the compressed data in the requested slot.
+    # A length of None means the data extends until the end of the file.
+    if in_file.read(10) != b"RENPY RPC2":
+        return 0, None
+
+    while True:
+        chunk_slot, start, length = struct.unpack("III", in_file.read(12))
+        if chunk_slot == slot:
+            return start, length
+        if chunk_slot == 0:
+            raise ValueError("RPC2 file does not contain slot %d" % slot)
+
+def read_ast_from_file(in_file, use_mmap=False, profiler=None, stream=False):
+    if use_mmap:
+        # The slot table is parsed from the mapping and the slot is inflated straight from it,
+        # so the compressed data never gets copied into our memory.
+        mapping = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start, length = find_rpyc_chunk(mapping)
+            return load_ast(MappedReader(mapping, start), length, profiler, stream)
+        finally:
+            mapping.close()
+
+    start, length = find_rpyc_chunk(in_file)
+    in_file.seek(start)
+    return load_ast(in_file, length, profiler, stream)
+
+def load_ast(in_file, length=None, profiler=None, stream=False):
+    # Unpickles the AST from the zlib compressed data at the current position of in_file.
+    # The C unpickler calls back into python for every read from a stream it doesn't know,
+    # so it's much faster to inflate the data first than to unpickle while inflating.
+    # If stream is set, this returns a NodeStream which unpickles the statements as they're used.
+    with profile_stage(profiler, "inflate"):
+        raw_contents = inflate(in_file, length)
+    if stream:
+        unpickler = StatementUnpickler(raw_contents)
+        return NodeStream(unpickler.iter_statements(), tail=unpickler.last_statements)
+    with profile_stage(profiler, "unpickle"):
+        data, stmts = magic.safe_loads(raw_contents, class_factory, {"_ast"})
+    return stmts
+
+def get_opcode_table():
+    # For every opcode: the size of its argument, whether it pops the stack down to the last mark,
+    # and how it changes the depth of the stack (counting from the mark if it pops to it)
+    table = {}
+    for op in pickletools.opcodes:
+        size = 0 if op.arg is None else op.arg.n
+        if pickletools.markobject in op.stack_before:
+            table[op.code] = (size, True, len(op.stack_after) - op.stack_before.index(pickletools.markobject))
+        else:
+            table[op.code] = (size, False, len(op.stack_after) - len(op.stack_before))
+    return table
+
+OPCODE_TABLE = get_opcode_table()
+
+class PickleScan(object):
+    """
+    Walks over the opcodes of the pickle of an .rpyc file without creating any objects, which
+    is a lot faster than pickletools.genops. It finds:
+
+    * ``references``: the memo keys which are fetched by GET opcodes, in the form the python
+      unpickler uses for them.
+    * ``tail``: the start and end offsets of the opcodes which unpickle each of the last two
+      statements. Each of these ranges pushes a single statement onto an empty stack. This is
+      None if there's no statement list at the bottom of the stack.
+    * ``value_offsets`` and ``put_offsets``: for every memo key from ``first_key`` on, the
+      offset of the opcode which pushed the value that was stored and of the PUT which stored
+      it. These are None if the memo keys weren't numbered in order.
+    """
+
+    def __init__(self, data):
+        # Indexing a bytearray returns ints, indexing a buffer of it returns strings
+        view = buffer(data)
+        table = OPCODE_TABLE
+        references = set()
+        tail = deque(maxlen=2)
+        # The depth and offset of every value pushed in the current batch of statements which
+        # is still on the stack. Once the batch is appended, these are the statements.
+        pushed = []
+        value_offsets = array.array('i')
+        put_offsets = array.array('i')
+        unpack = struct.unpack_from
+        find = data.find
+        position = previous = 0
+        depth = 0
+        marks = []
+        first_key = None
         while True:
-            slot, start, length = struct.unpack("III", raw_contents[position: position + 12])
-            if slot == 0:
+            start = position
+            code = view[position]
+            position += 1
+            size, to_mark, change = table[code]
+            if to_mark:
+                depth = marks.pop() + change
+            else:
+                # stmts is the list at depth 2, after the data dict. A batch of statements
+                # is either pushed after a MARK, or is a single statement pushed right onto it.
+                if change > 0 and code != pickle.MARK and (marks == [2] or (depth == 2 and not marks)):
+                    pushed.append((depth, start))
+                if code == pickle.MARK:
+                    marks.append(depth)
+                depth += change
+
+            if pushed and depth <= pushed[-1][0]:
+                if depth == 2 and not marks and code in (pickle.APPEND, pickle.APPENDS):
+                    # Each statement ends where the next one starts
+                    ends = [i[1] for i in pushed[1:]] + [start]
+                    tail.extend((i[1], end) for i, end in zip(pushed[-2:], ends[-2:]))
+                while pushed and depth <= pushed[-1][0]:
+                    pushed.pop()
+
+            key = None
+            if size > 0:
+                if code == pickle.BINGET:
+                    references.add(repr(ord(view[position])))
+                elif code == pickle.LONG_BINGET:
+                    references.add(repr(unpack("<i", data, position)[0]))
+                elif code == pickle.BINPUT:
+                    key = ord(view[position])
+                elif code == pickle.LONG_BINPUT:
+                    key = unpack("<i", data, position)[0]
+                position += size
+            elif size == pickletools.UP_TO_NEWLINE:
+                end = find(b"\n", position) + 1
+                if code == pickle.GET:
+                    references.add(view[position:end - 1])
+                elif code == pickle.PUT:
+                    key = int(view[position:end - 1])
+                elif code in (pickle.GLOBAL, pickle.INST):
+                    end = find(b"\n", end) + 1
+                position = end
+            elif size == pickletools.TAKEN_FROM_ARGUMENT1:
+                position += 1 + ord(view[position])
+            elif size == pickletools.TAKEN_FROM_ARGUMENT4:
+                position += 4 + unpack("<i", data, position)[0]
+            elif code == pickle.STOP:
                 break
-            position += 12
 
-            chunks[slot] = raw_contents[start: start + length]
+            if key is not None and put_offsets is not None:
+                if first_key is None:
+                    first_key = key
+                if key == first_key + len(put_offsets):
+                    value_offsets.append(previous)
+                    put_offsets.append(start)
+                else:
+                    value_offsets = put_offsets = None
+            previous = start
 
-        raw_contents = chunks[1]
+        self.references = references
+        self.tail = list(tail) if tail else None
+        self.first_key = first_key
+        self.value_offsets = value_offsets
+        self.put_offsets = put_offsets
 
-    raw_contents = raw_contents.decode('zlib')
-    data, stmts = magic.safe_loads(raw_contents, class_factory, {"_ast"})
-    return stmts
+class SparseMemo(dict):
+    # An unpickler memo which only stores the objects that will be fetched again
+    def __init__(self, references):
+        dict.__init__(self)
+        self.references = references
+
+    def __setitem__(self, key, value):
+        if key in self.references:
+            dict.__setitem__(self, key, value)
+
+class StatementUnpickler(magic.SafeUnpickler):
+    """
+    Unpickles the (data, stmts) tuple of an .rpyc file, but hands out the top-level statements
+    as they are unpickled instead of adding them to stmts. As the memo only keeps the objects
+    which are referenced again, nothing but the consumer of the statements keeps them alive.
+    This uses the python unpickler and is therefore a lot slower than load_ast.
+    """
+    dispatch = magic.SafeUnpickler.dispatch.copy()
+
+    def __init__(self, data):
+        magic.SafeUnpickler.__init__(self, StringIO(data), class_factory, {"_ast"})
+        self.data = data
+        self.scan = PickleScan(data)
+        self.memo = SparseMemo(self.scan.references)
+        self.statements = deque()
+
+    def last_statements(self):
+        # The last statements of the file, unpickled separately without reading the rest
+        # of the file. None if this isn't possible.
+        if self.scan.tail is None or self.scan.put_offsets is None:
+            return None
+        try:
+            return TailUnpickler(self.data, self.scan).load_tail()
+        except Exception:
+            return None
+
+    def is_statement_list(self, index):
+        # stmts is the list below the data dict at the bottom of the stack
+        stack = self.stack
+        return index == 1 and isinstance(stack[0], dict) and isinstance(stack[1], list)
+
+    def load_append(self):
+        if self.is_statement_list(len(self.stack) - 2):
+            self.statements.append(self.stack.pop())
+        else:
+            magic.SafeUnpickler.load_append(self)
+    dispatch[pickle.APPEND] = load_append
+
+    def load_appends(self):
+        mark = self.marker()
+        if self.is_statement_list(mark - 1):
+            self.statements.extend(self.stack[mark + 1:])
+            del self.stack[mark:]
+        else:
+            magic.SafeUnpickler.load_appends(self)
+    dispatch[pickle.APPENDS] = load_appends
+
+    def iter_statements(self):
+        # The load loop of pickle.Unpickler, which yields the statements after every opcode
+        self.mark = object()
+        self.stack = []
+        self.append = self.stack.append
+        read = self.read
+        dispatch = self.dispatch
+        statements = self.statements
+        try:
+            while True:
+                dispatch[read(1)](self)
+                while statements:
+                    yield statements.popleft()
+        except pickle._Stop:
+            pass
+
+class TailMemo(dict):
+    """
+    The memo of an unpickler which starts in the middle of a pickle. Entries which were stored
+    before that are recreated from the value that was stored, if it's a single opcode like a
+    class or a string. Other values aren't available and are replaced by placeholders.
+    """
+    ATOMIC_OPCODES = frozenset((pickle.GLOBAL, pickle.SHORT_BINSTRING, pickle.BINSTRING, pickle.STRING,
+                                pickle.BINUNICODE, pickle.UNICODE, pickle.BININT, pickle.BININT1,
+                                pickle.BININT2, pickle.INT, pickle.LONG1, pickle.LONG, pickle.BINFLOAT,
+                                pickle.FLOAT, pickle.NONE, pickle.NEWTRUE, pickle.NEWFALSE))
+
+    def __init__(self, data, scan):
+        dict.__init__(self)
+        self.view = buffer(data)
+        self.scan = scan
+
+    def __missing__(self, key):
+        index = int(key) - self.scan.first_key
+        if not 0 <= index < len(self.scan.put_offsets):
+            raise KeyError(key)
+        start, end = self.scan.value_offsets[index], self.scan.put_offsets[index]
+        if self.view[start] in self.ATOMIC_OPCODES:
+            value = magic.safe_loads(self.view[start:end] + pickle.STOP, class_factory, {"_ast"})
+        else:
+            value = object()
+        self[key] = value
+        return value
+
+class TailUnpickler(magic.SafeUnpickler):
+    # Unpickles the last statements found by a PickleScan, without reading anything else
+    def __init__(self, data, scan):
+        self.in_file = StringIO(data)
+        magic.SafeUnpickler.__init__(self, self.in_file, class_factory, {"_ast"})
+        self.memo = TailMemo(data, scan)
+        self.tail = scan.tail
+
+    def load_tail(self):
+        # The load loop of pickle.Unpickler, run over the opcodes of each statement
+        statements = []
+        read = self.read
+        dispatch = self.dispatch
+        for start, end in self.tail:
+            self.mark = object()
+            self.stack = []
+            self.append = self.stack.append
+            self.in_file.seek(start)
+            while self.in_file.tell() < end:
+                dispatch[read(1)](self)
+            statements.append(self.stack[-1])
+        return statements
+
+def get_cache_key(input_filename, options):
+    # The key of a file in the decompilation cache. It covers the compressed AST and everything
+    # else that influences the output, so a file whose key didn't change doesn't have to be
+    # unpickled at all.
+    key = hashlib.sha1(options)
+    with open_rpyc(input_filename) as in_file:
+        start, length = find_rpyc_chunk(in_file)
+        in_file.seek(start)
+        for data in read_chunks(in_file, length):
+            key.update(data)
+    return key.hexdigest()
+
+def get_decompiler_digest():
+    # A digest of the source of unrpyc and the decompiler package. It's part of the cache key, so
+    # files are decompiled again after unrpyc was updated.
+    digest = hashlib.sha1()
+    base = path.dirname(path.abspath(__file__))
+    package = path.join(base, "decompiler")
+    for filename in [path.join(base, "unrpyc.py")] + sorted(glob.glob(path.join(package, "*.py"))):
+        with open(filename, 'rb') as source:
+            digest.update(path.basename(filename))
+            digest.update(source.read())
+    return digest.hexdigest()
+
+def load_manifest(manifest_filename):
+    # Returns the dict of input filename -> value stored in a manifest file, such as the
+    # decompilation cache or the timings of earlier runs.
+    if not path.exists(manifest_filename):
+        return {}
+    with open(manifest_filename, 'rb') as manifest_file:
+        manifest = json.load(manifest_file)
+    # Filenames are stored relative to the manifest, so the tree can be moved together with it.
+    base = path.dirname(path.abspath(manifest_filename))
+    return dict((path.normpath(path.join(base, k)), v) for k, v in manifest.iteritems())
+
+def save_manifest(manifest_filename, values):
+    base = path.dirname(path.abspath(manifest_filename))
+    manifest = dict((path.relpath(k, base), v) for k, v in values.iteritems())
+    with open(manifest_filename, 'wb') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+def estimate_costs(filenames, timings):
+    # Estimate how long each file will take to process. Files which were processed before take as
+    # long as they did last time. For other files the compressed size is converted to seconds using
+    # the average throughput of the known files, or used as is if no timings are known at all.
+    sizes = dict((filename, get_input_size(filename)) for filename in filenames)
+    known = [filename for filename in filenames if path.abspath(filename) in timings]
+    known_size = sum(sizes[filename] for filename in known)
+    rate = sum(timings[path.abspath(filename)] for filename in known) / known_size if known_size else 1.
+
+    costs = {}
+    for filename in filenames:
+        costs[filename] = timings.get(path.abspath(filename), sizes[filename] * rate)
+    return costs
+
+class Profiler(object):
+    """
+    Records where the time of decompiling goes. Every stage of decompile_rpyc gets its wall time
+    and the amount of objects it left behind (the growth of the objects tracked by the garbage
+    collector, python 2 can't count allocations). Every kind of AST node the decompilers dispatch
+    on, and every print method they dispatch to, gets its amount of calls and the time spent in it
+    with (total) and without (own) its children. Profilers of separate files can be combined
+    through ``stats`` and ``merge``.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.nodes = {}
+        self.handlers = {}
+        self.stack = []
+        self.active = {}
+
+    @contextmanager
+    def stage(self, name):
+        objects = len(gc.get_objects())
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.time() - start, len(gc.get_objects()) - objects)
+
+    def add_stage(self, name, duration, objects=0):
+        stats = self.stages.setdefault(name, [0., 0])
+        stats[0] += duration
+        stats[1] += objects
+
+    def call(self, key, func, decompiler, *args):
+        # Calls the print method func of decompiler for the node identified by key, accounting the
+        # time it takes to both
+        handler = "%s.%s" % (type(decompiler).__name__, func.__name__)
+        self.stack.append(0.)
+        self.active[key] = self.active.get(key, 0) + 1
+        self.active[handler] = self.active.get(handler, 0) + 1
+        start = time.time()
+        try:
+            return func(decompiler, *args)
+        finally:
+            duration = time.time() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += duration
+            self.record(self.nodes, key, duration, children)
+            self.record(self.handlers, handler, duration, children)
+
+    def record(self, table, key, duration, children):
+        self.active[key] -= 1
+        stats = table.setdefault(key, [0, 0., 0.])
+        stats[0] += 1
+        # Nested calls with the same key are already part of the total of the outermost one
+        if not self.active[key]:
+            stats[1] += duration
+        stats[2] += duration - children
+
+    def stats(self):
+        return {"stages": self.stages, "nodes": self.nodes, "handlers": self.handlers}
+
+    def merge(self, stats):
+        for name, (duration, objects) in stats["stages"].iteritems():
+            self.add_stage(name, duration, objects)
+        for table in ("nodes", "handlers"):
+            for key, values in stats[table].iteritems():
+                totals = getattr(self, table).setdefault(key, [0, 0., 0.])
+                for i, value in enumerate(values):
+                    totals[i] += value
+
+    def report(self):
+        print "%-40s %10s %12s" % ("Stage", "Time", "Objects")
+        for name, (duration, objects) in sorted(self.stages.iteritems(), key=lambda i: -i[1][0]):
+            print "%-40s %9.3fs %12d" % (name, duration, objects)
+        if self.nodes:
+            print
+            print "%-40s %10s %10s %10s" % ("Node", "Calls", "Total", "Own")
+            for key, (calls, total, own) in sorted(self.nodes.iteritems(), key=lambda i: -i[1][2]):
+                print "%-40s %10d %9.3fs %9.3fs" % (key, calls, total, own)
+
+    def histogram(self, width=40):
+        # Prints the print methods which took the most time, with a bar proportional to their own time
+        handlers = sorted(self.handlers.iteritems(), key=lambda i: -i[1][2])
+        longest = max(own for calls, total, own in self.handlers.itervalues()) if handlers else 0
+        print "%-40s %10s %10s %10s" % ("Handler", "Calls", "Total", "Own")
+        for key, (calls, total, own) in handlers:
+            bar = "#" * int(round(width * own / longest)) if longest else ""
+            print ("%-40s %10d %9.3fs %9.3fs %s" % (key, calls, total, own, bar)).rstrip()
+
+@contextmanager
+def profile_stage(profiler, name):
+    # Records the enclosed code as a stage if we're profiling
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
+
+def output_extension(dump=False, export=False):
+    if export:
+        return '.jsonl'
+    return '.txt' if dump else '.rpy'
 
 def decompile_rpyc(input_filename, overwrite=False, dump=False, decompile_python=False,
-                   comparable=False, no_pyexpr=False, translator=None, init_offset=False):
+                   comparable=False, no_pyexpr=False, translator=None, init_offset=False,
+                   use_mmap=False, profiler=None, stream=False, export=False):
     # Output filename is input filename but with .rpy extension
     filepath, ext = path.splitext(input_filename)
-    out_filename = filepath + ('.txt' if dump else '.rpy')
+    out_filename = filepath + output_extension(dump, export)
 
     with printlock:
         print "Decompiling %s to %s..." % (input_filename, out_filename)
@@ -92,52 +679,488 @@ def decompile_rpyc(input_filename, overwrite=False, dump=False, decompile_python
             print "Output file already exists. Pass --clobber to overwrite."
             return False # Don't stop decompiling if one file already exists
 
-    with open(input_filename, 'rb') as in_file:
-        ast = read_ast_from_file(in_file)
+    # Statements can only be decompiled while they're unpickled if nothing has to see all of them first
+    stream = stream and (export or not dump) and translator is None and not init_offset
+    # Archive entries can't be mapped on their own, they're read in chunks as they're inflated
+    use_mmap = use_mmap and not isinstance(input_filename, ArchiveEntry)
+    with open_rpyc(input_filename) as in_file:
+        ast = read_ast_from_file(in_file, use_mmap, profiler, stream)
+
+    out_dir = path.dirname(out_filename)
+    if out_dir and not path.isdir(out_dir):
+        # Archive entries can be in directories which weren't extracted
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            if not path.isdir(out_dir):
+                raise
 
     with codecs.open(out_filename, 'w', encoding='utf-8') as out_file:
-        if dump:
+        write_ast(out_file, ast, dump, decompile_python, comparable, no_pyexpr, translator, init_offset,
+                  profiler, export)
+    return True
+
+def write_ast(out_file, ast, dump=False, decompile_python=False, comparable=False, no_pyexpr=False,
+              translator=None, init_offset=False, profiler=None, export=False):
+    # Writes the decompiled code, the dump or the export of ast to out_file
+    if export:
+        with profile_stage(profiler, "export"):
+            astdump.export(out_file, ast, decompile_python=decompile_python, comparable=comparable,
+                                          no_pyexpr=no_pyexpr)
+    elif dump:
+        with profile_stage(profiler, "dump"):
             astdump.pprint(out_file, ast, decompile_python=decompile_python, comparable=comparable,
                                           no_pyexpr=no_pyexpr)
-        else:
+    else:
+        with profile_stage(profiler, "decompile"):
             decompiler.pprint(out_file, ast, decompile_python=decompile_python, printlock=printlock,
-                                             translator=translator, init_offset=init_offset)
-    return True
+                                             translator=translator, init_offset=init_offset,
+                                             profiler=profiler)
+
+def decompile_data(data, dump=False, decompile_python=False, comparable=False, no_pyexpr=False,
+                   translator=None, init_offset=False, stream=False, export=False):
+    """
+    Decompiles the contents of a .rpyc file, which are passed as a string, and returns the
+    result as unicode. The options are those of decompile_rpyc. Nothing touches the filesystem.
+    """
+    stream = stream and (export or not dump) and translator is None and not init_offset
+    ast = read_ast_from_file(StringIO(data), stream=stream)
 
-def extract_translations(input_filename, language):
+    # Encode the output like decompile_rpyc does, so the result is exactly what it would write
+    out_file = codecs.getwriter('utf-8')(StringIO())
+    write_ast(out_file, ast, dump, decompile_python, comparable, no_pyexpr, translator, init_offset,
+              export=export)
+    return out_file.getvalue().decode('utf-8')
+
+def decompile_data_task(t):
+    # decompile_data for worker processes, with the translations loaded in the process
+    (name, data, options) = t
+    return try_decompile_data(name, data, get_translator(), options)
+
+def try_decompile_data(name, data, translator, options):
+    # Failures are reported here, the batch only gets None
+    try:
+        return decompile_data(data, translator=translator, **options)
+    except Exception as e:
+        with printlock:
+            print "Error while decompiling %s:" % name
+            print traceback.format_exc()
+        return None
+
+def decompile_batch(items, sink=None, processes=None, translation_data=None, **options):
+    """
+    Decompiles many .rpyc files which are already in memory. *items* is an iterable of
+    (name, data) pairs, where data holds the contents of a .rpyc file. This yields a
+    (name, text) pair for every item in the same order, where text is the decompiled code
+    as unicode, or None if decompiling the item failed.
+
+    If *sink* is passed, it's called as sink(name) for every item which was decompiled and
+    should return a file-like object to write its text to. The text isn't kept and the pairs
+    which are yielded are (name, success) instead.
+
+    The items are decompiled by a pool of *processes* worker processes, which defaults to
+    the amount of CPUs. Only a few items per process are handed out at a time, so *items*
+    can be a generator over more data than fits in memory. *translation_data* is the
+    contents of a translation file to use, like the file passed with -t. The other keyword
+    arguments are the options of decompile_data.
+    """
+    processes = cpu_count() if processes is None else processes
+    # decompile starts decompiling an item and returns a function which waits for its text
+    if processes > 1:
+        pool = Pool(processes, init_worker, [printlock, translation_data])
+        def decompile(t):
+            return pool.apply_async(decompile_data_task, (t,)).get
+    else:
+        # Don't replace the translations loaded in this process, they may be used by something else
+        loaded_translations = read_translations(translation_data)
+        pool = None
+        def decompile(t):
+            text = try_decompile_data(t[0], t[1], make_translator(loaded_translations), t[2])
+            return lambda: text
+
+    def result(name, get):
+        text = get()
+        if sink is None:
+            return name, text
+        if text is not None:
+            out_file = sink(name)
+            out_file.write(text)
+        return name, text is not None
+
+    try:
+        pending = deque()
+        for name, data in items:
+            pending.append((name, decompile((name, data, options))))
+            # Keep every worker busy while handing out as little data as possible
+            if len(pending) > 2 * processes:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def dump_dict_items(items, out_file):
+    # Writes the items as a pickle fragment which adds them to the dict on top of the unpickler's
+    # stack. These fragments can be concatenated without having to unpickle them again.
+    pickler = magic.SafePickler(out_file, 2)
+    out_file.write(pickle.MARK)
+    for key, value in items:
+        pickler.save(key)
+        pickler.save(value)
+    out_file.write(pickle.SETITEMS)
+
+def extract_translations(input_filename, language, shard_filename, use_mmap=False, profiler=None):
     with printlock:
         print "Extracting translations from %s..." % input_filename
 
-    with open(input_filename, 'rb') as in_file:
-        ast = read_ast_from_file(in_file)
+    use_mmap = use_mmap and not isinstance(input_filename, ArchiveEntry)
+    with open_rpyc(input_filename) as in_file:
+        ast = read_ast_from_file(in_file, use_mmap, profiler)
 
     translator = translate.Translator(language, True)
-    translator.translate_dialogue(ast)
-    # we pickle and unpickle this manually because the regular unpickler will choke on it
-    return magic.safe_dumps(translator.dialogue), translator.strings
+    with profile_stage(profiler, "translate"):
+        translator.translate_dialogue(ast)
+    # we write these as pickle fragments because the regular unpickler will choke on them, and this
+    # way they can be merged into the translation file without unpickling them at all.
+    with open(shard_filename, 'wb') as shard:
+        dump_dict_items(translator.dialogue.iteritems(), shard)
+        dialogue_length = shard.tell()
+        dump_dict_items(translator.strings.iteritems(), shard)
+    return dialogue_length
+
+class TranslationMerger(object):
+    """
+    Merges the shards written by extract_translations into a translation file. The result is the
+    same as that of ``magic.safe_dump((language, dialogue, strings), out_file)``, but the shards are
+    copied into it as they are, so the translations never have to be held in memory.
+    """
+    def __init__(self, out_file, language):
+        self.out_file = out_file
+        self.shards = []
 
-def worker(t):
-    (args, filename, filesize) = t
+        pickler = magic.SafePickler(out_file, 2)
+        pickler.fast = True # don't memoize, the shards reuse the memo
+        out_file.write(pickle.PROTO + chr(2))
+        pickler.save(language)
+        out_file.write(pickle.EMPTY_DICT)
+
+    def copy(self, shard_filename, start, length):
+        with open(shard_filename, 'rb') as shard:
+            shard.seek(start)
+            for data in read_chunks(shard, length):
+                self.out_file.write(data)
+
+    def add(self, shard_filename, dialogue_length):
+        # The dialogue can be written immediately, the strings have to wait until all dialogue is in.
+        self.copy(shard_filename, 0, dialogue_length)
+        self.shards.append((shard_filename, dialogue_length))
+
+    def close(self):
+        self.out_file.write(pickle.EMPTY_DICT)
+        for shard_filename, dialogue_length in self.shards:
+            self.copy(shard_filename, dialogue_length, None)
+        self.out_file.write(pickle.TUPLE3 + pickle.STOP)
+
+def worker(t, profiler=None):
+    # Returns False if the file failed. Otherwise this returns the shard filename and the length of the
+    # dialogue in it if extracting translations, or the cache key of the file and whether it was skipped.
+    (args, filename, cost, cached_key) = t
     try:
         if args.write_translation_file:
-            return extract_translations(filename, args.language)
+            fd, shard_filename = tempfile.mkstemp(".pickle", dir=args.shard_dir)
+            os.close(fd)
+            return shard_filename, extract_translations(filename, args.language, shard_filename, args.mmap,
+                                                        profiler)
         else:
-            if args.translation_file is not None:
-                translator = translate.Translator(None)
-                translator.language, translator.dialogue, translator.strings = magic.loads(args.translations, class_factory)
+            key = None
+            if args.cache_file is not None:
+                key = get_cache_key(filename, args.cache_options)
+                out_filename = path.splitext(filename)[0] + output_extension(args.dump, args.export)
+                if key == cached_key and path.exists(out_filename):
+                    with printlock:
+                        print "Skipping unchanged %s" % filename
+                    return key, True
+
+            decompile_args = (filename, args.clobber, args.dump, args.decompile_python, args.comparable,
+                              args.no_pyexpr, get_translator(), args.init_offset, args.mmap, profiler, args.stream,
+                              args.export)
+            if filename in args.cprofile_files:
+                # Dump a full profile of the decompilation of the file next to its output
+                profile = cProfile.Profile()
+                success = profile.runcall(decompile_rpyc, *decompile_args)
+                profile.dump_stats(path.splitext(filename)[0] + '.prof')
             else:
-                translator = None
-            return decompile_rpyc(filename, args.clobber, args.dump, decompile_python=args.decompile_python,
-                                  no_pyexpr=args.no_pyexpr, comparable=args.comparable, translator=translator, init_offset=args.init_offset)
+                success = decompile_rpyc(*decompile_args)
+            if success:
+                return key, False
+            return False
     except Exception as e:
         with printlock:
             print "Error while decompiling %s:" % filename
             print traceback.format_exc()
         return False
 
-def sharelock(lock):
+def timed_worker(t):
+    # Wraps worker so results can be matched to their file when they arrive out of order,
+    # and so we can learn how expensive each file is to decompile.
+    profiler = Profiler() if t[0].profile or t[0].histogram else None
+    start = time.time()
+    result = worker(t, profiler)
+    return t[1], result, time.time() - start, profiler and profiler.stats()
+
+def get_translator():
+    # A translator for the translations loaded by load_translations, if there are any
+    return make_translator(translations)
+
+def make_translator(loaded_translations):
+    # A translator for translations returned by read_translations, if there are any
+    if loaded_translations is None:
+        return None
+    translator = translate.Translator(None)
+    translator.language, translator.dialogue, translator.strings = loaded_translations
+    return translator
+
+def read_translations(data):
+    # The (language, dialogue, strings) stored in the contents of a translation file
+    return magic.loads(data, class_factory) if data is not None else None
+
+def load_translations(data):
+    global translations
+    translations = read_translations(data)
+
+def init_worker(lock, translation_data):
     global printlock
     printlock = lock
+    load_translations(translation_data)
+
+# Server mode
+
+# The options of decompile_data which jobs sent to the server can set
+SERVER_OPTIONS = ("dump", "export", "decompile_python", "comparable", "no_pyexpr", "init_offset", "stream")
+
+def serve_job(t):
+    # Runs a job sent to the server and returns the response to it
+    (job, defaults) = t
+    response = {"id": job.get("id")}
+    try:
+        options = dict(defaults)
+        options.update((key, job[key]) for key in SERVER_OPTIONS if key in job)
+        if "data" in job:
+            data = base64.b64decode(job["data"])
+        else:
+            with open_rpyc(job["file"]) as in_file:
+                data = in_file.read()
+        response["output"] = decompile_data(data, translator=get_translator(), **options)
+    except Exception as e:
+        response["error"] = traceback.format_exc()
+    return response
+
+def init_server_worker(lock, translation_data):
+    # Nothing else may write to the output of the server, so anything printed goes to stderr.
+    # Interrupting the server is handled by the server, which then shuts the workers down.
+    sys.stdout = sys.stderr
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(lock, translation_data)
+
+class Server(object):
+    """
+    Decompiles the jobs it's sent with a pool of worker processes that stays around, so the cost
+    of starting up is only paid once. Jobs are read as JSON lines from a file-like object, like
+    stdin or a connection to a unix socket, and each gets a JSON line in response, as soon as it's
+    done. A job is an object like
+
+        {"id": 1, "file": "game/script.rpyc"}
+
+    where "data" can be passed with the base64 encoded contents of a .rpyc file instead of
+    "file", and any of SERVER_OPTIONS can be set to override the options the server was started
+    with. The response is {"id": 1, "output": text} or {"id": 1, "error": traceback}.
+    """
+    def __init__(self, processes, translation_data, defaults):
+        self.defaults = defaults
+        if processes > 1:
+            self.pool = Pool(processes, init_server_worker, [printlock, translation_data])
+        else:
+            load_translations(translation_data)
+            self.pool = None
+
+    def serve(self, in_file, out_file):
+        # Handles the jobs read from in_file until it ends, and waits until all of them are done
+        write_lock = threading.Lock()
+        def respond(response):
+            line = json.dumps(response) + "\n"
+            with write_lock:
+                try:
+                    out_file.write(line)
+                    out_file.flush()
+                except (IOError, socket.error):
+                    pass # the client went away
+
+        pending = []
+        for line in iter(in_file.readline, b""):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("a job has to be a JSON object")
+            except ValueError as e:
+                respond({"id": None, "error": "Invalid job: %s" % e})
+                continue
+
+            if self.pool is None:
+                respond(serve_job((job, self.defaults)))
+            else:
+                pending.append(self.pool.apply_async(serve_job, ((job, self.defaults),), callback=respond))
+                pending = [i for i in pending if not i.ready()]
+        for i in pending:
+            i.wait()
+
+    def serve_socket(self, socket_filename):
+        # Accepts connections to a unix socket until interrupted, and serves each of them
+        if path.exists(socket_filename):
+            if not self.is_stale_socket(socket_filename):
+                print "%s already exists and is not the socket of a crashed server." % socket_filename
+                return
+            os.remove(socket_filename)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Jobs can read any file the server can, so only our own user may connect
+        umask = os.umask(0o177)
+        try:
+            listener.bind(socket_filename)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_filename, 0o600)
+        listener.listen(5)
+        print "Listening on %s..." % socket_filename
+        # Being terminated shuts the server down as cleanly as being interrupted
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                connection, address = listener.accept()
+                thread = threading.Thread(target=self.serve_connection, args=(connection,))
+                thread.daemon = True
+                thread.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.remove(socket_filename)
+
+    def is_stale_socket(self, socket_filename):
+        # Whether socket_filename is a socket which nothing listens on anymore
+        if not stat.S_ISSOCK(os.stat(socket_filename).st_mode):
+            return False
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_filename)
+        except socket.error:
+            return True
+        finally:
+            probe.close()
+        return False
+
+    def serve_connection(self, connection):
+        try:
+            self.serve(connection.makefile('rb'), connection.makefile('wb'))
+        finally:
+            connection.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+def serve(args, translation_data):
+    # The responses are written to stdout, so anything else that's printed goes to stderr
+    out_file = sys.stdout
+    sys.stdout = sys.stderr
+
+    defaults = dict((key, getattr(args, key)) for key in SERVER_OPTIONS)
+    server = Server(int(args.processes), translation_data, defaults)
+    try:
+        if args.socket:
+            server.serve_socket(args.socket)
+        else:
+            server.serve(sys.stdin, out_file)
+    finally:
+        server.close()
+
+def decompile_files(args, files, cache, translation_data, timings, profiler):
+    # Decompiles the files, or extracts their translations, with a pool of worker processes
+    # if requested. Returns the amount of files that succeeded and that failed.
+    costs = estimate_costs(files, timings)
+    args.cprofile_files = set(sorted(files, key=costs.get, reverse=True)[:args.cprofile])
+    files = map(lambda x: (args, x, costs[x], cache.get(path.abspath(x)) if cache else None), files)
+    processes = int(args.processes)
+    if processes > 1:
+        # If an expensive file starts near the end, there could be a long time with
+        # only one thread running, which is inefficient. Avoid this by starting
+        # the most expensive files first, and hand out the rest one at a time to
+        # whichever process is done first.
+        files.sort(key=itemgetter(2), reverse=True)
+        pool = Pool(processes, init_worker, [printlock, translation_data])
+        results = pool.imap_unordered(timed_worker, files, 1)
+    else:
+        # Decompile in the order Ren'Py loads in
+        files.sort(key=itemgetter(1))
+        load_translations(translation_data)
+        pool = None
+        results = itertools.imap(timed_worker, files)
+
+    # The translation shard of each file. These are merged in the order of the filenames once all
+    # are done, so which file wins when two translate the same identifier doesn't depend on timing.
+    shards = {}
+    good = 0
+    bad = 0
+    try:
+        for filename, result, duration, stats in results:
+            if stats is not None:
+                profiler.merge(stats)
+            if not result:
+                bad += 1
+                if cache is not None:
+                    cache.pop(path.abspath(filename), None)
+                continue
+            good += 1
+
+            if args.write_translation_file:
+                shards[filename] = result
+            else:
+                key, skipped = result
+                if skipped:
+                    # This duration says nothing about the cost of decompiling it
+                    continue
+                if cache is not None:
+                    cache[path.abspath(filename)] = key
+            timings[path.abspath(filename)] = duration
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if args.write_translation_file:
+        print "Writing translations to %s..." % args.write_translation_file
+        try:
+            with open(args.write_translation_file, 'wb') as translation_file:
+                merger = TranslationMerger(translation_file, args.language)
+                for filename in sorted(shards):
+                    merger.add(*shards[filename])
+                merger.close()
+        except BaseException:
+            # Don't leave a truncated translation file behind
+            if path.exists(args.write_translation_file):
+                os.remove(args.write_translation_file)
+            raise
+
+    return good, bad
 
 def main():
     # python27 unrpyc.py [-c] [-d] [--python-screens|--ast-screens|--no-screens] file [file ...]
@@ -149,6 +1172,10 @@ def main():
     parser.add_argument('-d', '--dump', dest='dump', action='store_true',
                         help="instead of decompiling, pretty print the ast to a file")
 
+    parser.add_argument('--json', dest='export', action='store_true',
+                        help="instead of decompiling, write the ast to a .jsonl file as JSON lines, one record per node. "
+                        "--sl1-as-python, --comparable and --no-pyexpr apply to this like they do to dumping.")
+
     parser.add_argument('-p', '--processes', dest='processes', action='store', default=cpu_count(),
                         help="use the specified number of processes to decompile")
 
@@ -179,20 +1206,82 @@ def main():
                         "This is always safe to enable if the game's Ren'Py version supports init offset statements, "
                         "and the generated code is exactly equivalent, only less cluttered.")
 
-    parser.add_argument('file', type=str, nargs='+',
+    parser.add_argument('--mmap', dest='mmap', action='store_true',
+                        help="Memory map the input files instead of reading them, so the compressed data is inflated "
+                        "straight from the mapping without being copied. The inflated data is still held in memory "
+                        "as a whole, so this does not lower peak memory usage. Files in archives are always read in chunks.")
+
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help="Decompile the statements of each file while it is being unpickled, "
+                        "so statements which were written can be freed. This caps memory usage on very large files, "
+                        "but unpickles a lot slower. It has no effect with --dump, --init-offset or a translation file, "
+                        "but it does with --json.")
+
+    parser.add_argument('--timings', dest='timings_file', action='store', default=None,
+                        help="Record how long every file took to decompile in the specified file, "
+                        "and use the timings of earlier runs to schedule the most expensive files first.")
+
+    parser.add_argument('--cache', dest='cache_file', action='store', default=None,
+                        help="Keep a manifest of decompiled files in the specified file. "
+                        "Files which did not change since they were last decompiled with the same options "
+                        "and the same version of unrpyc are skipped.")
+
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help="Measure how long each stage of decompiling and each kind of AST node takes, "
+                        "and print a report of this at the end.")
+
+    parser.add_argument('--histogram', dest='histogram', action='store_true',
+                        help="Count the calls of each print method of the decompilers and the time spent in them, "
+                        "and print a histogram of this at the end.")
+
+    parser.add_argument('--cprofile', dest='cprofile', type=int, action='store', default=0, metavar='N',
+                        help="Write a cProfile dump of the decompilation of the N most expensive files next to their output. "
+                        "Combine this with --timings to know which files these are.")
+
+    parser.add_argument('--serve', dest='serve', action='store_true',
+                        help="Instead of decompiling the files passed, keep running and decompile the jobs that are "
+                        "sent as JSON lines on stdin, writing a JSON line with the output or error of each job to stdout. "
+                        "The other options are the defaults of the jobs.")
+
+    parser.add_argument('--socket', dest='socket', action='store', default=None,
+                        help="With --serve, accept connections on the specified unix socket instead of using stdin "
+                        "and stdout.")
+
+    parser.add_argument('file', type=str, nargs='*',
                         help="The filenames to decompile. "
-                        "All .rpyc files in any directories passed or their subdirectories will also be decompiled.")
+                        "All .rpyc files in any directories passed or their subdirectories will also be decompiled. "
+                        "The .rpyc files in Ren'Py archives (.rpa) are decompiled without extracting them, "
+                        "to where they would be extracted.")
 
     args = parser.parse_args()
 
+    if not args.file and not args.serve:
+        parser.error("too few arguments")
+
     if args.write_translation_file and not args.clobber and path.exists(args.write_translation_file):
         # Fail early to avoid wasting time going through the files
         print "Output translation file already exists. Pass --clobber to overwrite."
         return
 
+    translation_data = None
     if args.translation_file:
         with open(args.translation_file, 'rb') as in_file:
-            args.translations = in_file.read()
+            translation_data = in_file.read()
+
+    if args.serve:
+        serve(args, translation_data)
+        return
+
+    cache = None
+    if args.write_translation_file:
+        args.cache_file = None
+    elif args.cache_file:
+        cache = load_manifest(args.cache_file)
+        # Everything besides the file itself which affects the output
+        args.cache_options = repr((get_decompiler_digest(),
+                                   args.dump, args.export, args.decompile_python, args.comparable, args.no_pyexpr,
+                                   args.init_offset,
+                                   translation_data and hashlib.sha1(translation_data).hexdigest()))
 
     # Expand wildcards
     def glob_or_complain(s):
@@ -204,54 +1293,55 @@ def main():
     # Concatenate lists
     filesAndDirs = list(itertools.chain(*filesAndDirs))
 
-    # Recursively add .rpyc files from any directories passed
+    # Recursively add .rpyc files and archives from any directories passed
     files = []
+    archives = []
     for i in filesAndDirs:
         if path.isdir(i):
             for dirpath, dirnames, filenames in walk(i):
                 files.extend(path.join(dirpath, j) for j in filenames if len(j) >= 5 and j[-5:] == '.rpyc')
+                archives.extend(path.join(dirpath, j) for j in filenames if j.endswith('.rpa'))
+        elif i.endswith('.rpa'):
+            archives.append(i)
         else:
             files.append(i)
 
+    # The .rpyc files in archives are decompiled from the archive, as if they were extracted next to
+    # it. Like in Ren'Py, files which were extracted already take precedence over those in archives.
+    extracted = set(path.abspath(i) for i in files)
+    for archive_filename in archives:
+        try:
+            entries = read_archive_index(archive_filename)
+        except Exception as e:
+            print "Could not read the index of %s: %s" % (archive_filename, e)
+            continue
+        for entry in entries:
+            if path.abspath(entry) not in extracted:
+                extracted.add(path.abspath(entry))
+                files.append(entry)
+
     # Check if we actually have files. Don't worry about
     # no parameters passed, since ArgumentParser catches that
     if len(files) == 0:
         print "No script files to decompile."
         return
 
-    files = map(lambda x: (args, x, path.getsize(x)), files)
-    processes = int(args.processes)
-    if processes > 1:
-        # If a big file starts near the end, there could be a long time with
-        # only one thread running, which is inefficient. Avoid this by starting
-        # big files first.
-        files.sort(key=itemgetter(2), reverse=True)
-        results = Pool(int(args.processes), sharelock, [printlock]).map(worker, files, 1)
-    else:
-        # Decompile in the order Ren'Py loads in
-        files.sort(key=itemgetter(1))
-        results = map(worker, files)
-
+    timings = load_manifest(args.timings_file) if args.timings_file else {}
+    profiler = Profiler() if args.profile or args.histogram else None
     if args.write_translation_file:
-        print "Writing translations to %s..." % args.write_translation_file
-        translated_dialogue = {}
-        translated_strings = {}
-        good = 0
-        bad = 0
-        for result in results:
-            if not result:
-                bad += 1
-                continue
-            good += 1
-            translated_dialogue.update(magic.loads(result[0], class_factory))
-            translated_strings.update(result[1])
-        with open(args.write_translation_file, 'wb') as out_file:
-            magic.safe_dump((args.language, translated_dialogue, translated_strings), out_file)
+        # Workers store the translations of every file in here
+        args.shard_dir = tempfile.mkdtemp(prefix="unrpyc-")
+    try:
+        good, bad = decompile_files(args, files, cache, translation_data, timings, profiler)
+    finally:
+        if args.write_translation_file:
+            shutil.rmtree(args.shard_dir, ignore_errors=True)
 
-    else:
-        # Check per file if everything went well and report back
-        good = results.count(True)
-        bad = results.count(False)
+    if cache is not None:
+        save_manifest(args.cache_file, cache)
+
+    if args.timings_file:
+        save_manifest(args.timings_file, timings)
 
     if bad == 0:
         print "Decompilation of %d script file%s successful" % (good, 's' if good>1 else '')
@@ -260,5 +1350,13 @@ def main():
     else:
         print "Decompilation of %d file%s successful, but decompilation of %d file%s failed" % (good, 's' if good>1 else '', bad, 's' if bad>1 else '')
 
+    if args.profile:
+        print
+        profiler.report()
+
+    if args.histogram:
+        print
+        profiler.histogram()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file